@@ -0,0 +1,61 @@
+import argparse
+import asyncio
+import random
+from aiohttp import web
+
+# Local stand-in for the broker APIs polled by tradepilot.brokers, for development and load testing.
+# Every account exists and returns a balance derived from its number; latency and error rates are
+# configurable so the retry and backoff paths can be exercised.
+
+def _amounts(account):
+    balance = 10000 + (sum(map(ord, account)) * 37) % 90000
+    return balance, balance + random.uniform(-500, 500)
+
+async def _simulate(request):
+    settings = request.app['settings']
+    await asyncio.sleep(random.uniform(0, 2 * settings.latency))
+    if random.random() < settings.rate_limited:
+        raise web.HTTPTooManyRequests(headers={'Retry-After': '1'})
+    if random.random() < settings.error_rate:
+        raise web.HTTPServiceUnavailable()
+    request.app['stats']['served'] += 1
+
+async def metatrader(request):
+    await _simulate(request)
+    balance, equity = _amounts(request.match_info['account'])
+    return web.json_response({'login': request.match_info['account'], 'balance': balance, 'equity': round(equity, 2)})
+
+async def dxtrade(request):
+    await _simulate(request)
+    balance, equity = _amounts(request.match_info['account'])
+    return web.json_response({'metrics': [{'account': request.match_info['account'], 'balance': balance, 'equity': round(equity, 2)}]})
+
+async def ctrader(request):
+    await _simulate(request)
+    balance, equity = _amounts(request.match_info['account'])
+    return web.json_response({'ctidTraderAccountId': request.match_info['account'], 'moneyDigits': 2,
+                              'balance': balance * 100, 'equity': int(equity * 100)})
+
+async def stats(request):
+    return web.json_response(request.app['stats'])
+
+def make_app(settings):
+    app = web.Application()
+    app['settings'] = settings
+    app['stats'] = {'served': 0}
+    app.add_routes([
+        web.get('/accounts/{account}', metatrader),
+        web.get('/dxsca-web/accounts/{account}/metrics', dxtrade),
+        web.get('/v2/tradingaccounts/{account}', ctrader),
+        web.get('/stats', stats),
+    ])
+    return app
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mock broker API for the balance sync')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean response time in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='share of requests answered with 503')
+    parser.add_argument('--rate-limited', type=float, default=0.01, help='share of requests answered with 429')
+    settings = parser.parse_args()
+    web.run_app(make_app(settings), port=settings.port)
@@ -5,12 +5,31 @@ from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
 from flask_migrate import Migrate
 from flask_dropzone import Dropzone
+from celery.schedules import crontab
 from .celery import make_celery
+from .db_routing import REPLICA_BIND, RoutingSession
 
 app = Flask(__name__)
 app._static_folder = '../static'
 app.config['SECRET_KEY'] = 'af4f41d883e5c91089432256fbf47ec562bdf45f35e7906f'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql://root:@localhost/tradepilot'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'mysql://root:@localhost/tradepilot')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 10)),
+    'pool_recycle': 3600,
+}
+
+# Optional read replica for read-only views and analytics tasks, with its own pool
+if os.environ.get('REPLICA_DATABASE_URL'):
+    app.config['SQLALCHEMY_BINDS'] = {
+        REPLICA_BIND: {
+            'url': os.environ['REPLICA_DATABASE_URL'],
+            'pool_size': int(os.environ.get('REPLICA_POOL_SIZE', 20)),
+            'max_overflow': int(os.environ.get('REPLICA_MAX_OVERFLOW', 20)),
+            'pool_recycle': 3600,
+        },
+    }
+app.config['READ_YOUR_WRITES_SECONDS'] = 10  # Stay on the primary this long after a user's own write
 app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, '../static/uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB
 
@@ -20,6 +39,49 @@ app.config['DROPZONE_ALLOWED_FILE_TYPE'] = 'image'
 app.config['DROPZONE_MAX_FILE_SIZE'] = 3  # 3 MB
 app.config['DROPZONE_MAX_FILES'] = 6
 
+# Rolling performance windows shown on the dashboard
+app.config['ROLLING_TRADE_WINDOW'] = 20  # last N trades
+app.config['ROLLING_DAY_WINDOW'] = 10  # last N trading days
+app.config['ROLLING_CACHE_USERS'] = int(os.environ.get('ROLLING_CACHE_USERS', 10000))  # users whose windows a worker keeps
+
+# Broker APIs polled by update_all_users_balance, keyed by UserData.platform. Platforms without a URL are skipped.
+app.config['BROKER_APIS'] = {
+    platform: {'url': os.environ.get(f'{platform.upper()}_API_URL'), 'token': os.environ.get(f'{platform.upper()}_API_TOKEN')}
+    for platform in ('MT4', 'MT5', 'DxTrade', 'Ctrader')
+}
+app.config['BROKER_SYNC_LOCK_TIMEOUT'] = 3600  # seconds before the lock of a crashed sweep expires
+
+# Trade ingestion API for expert advisors
+app.config['INGEST_MAX_BATCH'] = 1000  # trades per request
+app.config['INGEST_MAX_PENDING_PER_USER'] = 10  # queued batches before a user gets 429
+app.config['INGEST_MAX_PENDING'] = 500  # queued batches across all users before everyone gets 429
+app.config['INGEST_RETRY_AFTER'] = 5  # seconds, sent with 429
+
+# Monte Carlo risk simulation
+app.config['MONTE_CARLO_WORKERS'] = int(os.environ.get('MONTE_CARLO_WORKERS', os.cpu_count() or 1))  # processes per run
+app.config['MONTE_CARLO_CHUNK_MB'] = int(os.environ.get('MONTE_CARLO_CHUNK_MB', 256))  # memory per chunk, sets the paths per chunk
+
+# Trades opened more than ARCHIVE_AFTER_DAYS ago are moved to compressed per-user files (needs pyarrow)
+app.config['ARCHIVE_FOLDER'] = os.environ.get('ARCHIVE_FOLDER', os.path.join(app.root_path, '../archive'))
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+
+# Nightly cross-user analytics batch
+app.config['NIGHTLY_WORKERS'] = int(os.environ.get('NIGHTLY_WORKERS', os.cpu_count() or 1))  # processes
+app.config['NIGHTLY_CHUNK_USERS'] = 200  # users per chunk (one bulk trade read each)
+
+# Economic calendar used by the news breakdown
+app.config['ECONOMIC_CALENDAR_FEED'] = os.environ.get('ECONOMIC_CALENDAR_FEED')  # CSV or JSON file, loaded daily
+app.config['NEWS_WINDOW_MINUTES'] = 15  # a trade open within this many minutes of an event was held through it
+
+# OHLC bar store used for the trades' maximum adverse and favourable excursion
+app.config['BAR_FOLDER'] = os.environ.get('BAR_FOLDER', os.path.join(app.root_path, '../bars'))
+
+# Weekly and monthly reports, rendered in the background and served from the static folder
+app.config['REPORT_FOLDER'] = os.path.join(app.root_path, '../static/reports')
+
+# Per-worker cache of the users' trades as compact columns, least recently used users evicted first
+app.config['TRADE_CACHE_MB'] = int(os.environ.get('TRADE_CACHE_MB', 64))  # memory budget per process, 0 turns it off
+
 # Ensure the upload directory exists
 upload_dir = app.config['UPLOAD_FOLDER']
 if not os.path.exists(upload_dir):
@@ -34,9 +96,37 @@ app.config['beat_schedule'] = {
         'task': 'tradepilot.tasks.update_all_users_balance',
         'schedule': 300.0,  # Every 5 minutes
     },
+    'reset-checklists-daily': {
+        'task': 'tradepilot.tasks.reset_checklists',
+        'schedule': crontab(hour=0, minute=0),  # Every day at midnight
+    },
+    'purge-ingest-batches-daily': {
+        'task': 'tradepilot.tasks.purge_ingest_batches',
+        'schedule': crontab(hour=3, minute=0),
+    },
+    'archive-old-trades-nightly': {
+        'task': 'tradepilot.tasks.archive_trades',
+        'schedule': crontab(hour=2, minute=0),
+    },
+    'nightly-analytics': {
+        'task': 'tradepilot.tasks.nightly_analytics',
+        'schedule': crontab(hour=4, minute=0),
+    },
+    'load-economic-events-daily': {
+        'task': 'tradepilot.tasks.load_economic_events',
+        'schedule': crontab(hour=5, minute=0),
+    },
+    'compute-trade-excursions-hourly': {
+        'task': 'tradepilot.tasks.compute_trade_excursions',
+        'schedule': crontab(minute=30),
+    },
+    'queue-reports-hourly': {
+        'task': 'tradepilot.tasks.queue_reports',
+        'schedule': crontab(minute=45),
+    },
 }
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 bcrypt = Bcrypt(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
@@ -0,0 +1,209 @@
+import heapq
+import logging
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal
+from functools import lru_cache
+from tradepilot import app, db
+from tradepilot.models import Trade, TradeArchivePartition, TradeSnapshot, UserData
+from tradepilot.rollups import apply_trade_changes
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import feather
+except ImportError:  # Archiving is optional; without pyarrow trades simply stay in the live table
+    pa = None
+
+# Columns copied into the archive, so an archived trade keeps everything the live row had.
+ARCHIVE_COLUMNS = ('id', 'ticket', 'open_time', 'trade_type', 'size', 'item', 'price', 's_l', 't_p', 'close_time', 'close_price',
+                   'comm', 'taxes', 'swap', 'profit', 'pips', 'duration', 'mae', 'mfe', 'comments', 'strategy',
+                   'screenshot1', 'screenshot2', 'screenshot3')
+
+def _schema():
+    money, price = pa.decimal128(10, 2), pa.decimal128(13, 5)
+    types = {'id': pa.int64(), 'open_time': pa.timestamp('us'), 'close_time': pa.timestamp('us'), 'size': pa.float64(),
+             'duration': pa.duration('us'), 'price': price, 's_l': price, 't_p': price, 'close_price': price, 'comm': money,
+             'taxes': money, 'swap': money, 'profit': money, 'pips': price, 'mae': pa.float64(), 'mfe': pa.float64()}
+    return pa.schema([(column, types.get(column, pa.string())) for column in ARCHIVE_COLUMNS])
+
+def _partition_path(user_id, year):
+    return os.path.join(app.config['ARCHIVE_FOLDER'], f'user_{user_id}', f'{year}.arrow')
+
+# Rows returned by trade_rows: open_time and id (the sort key) plus the requested columns.
+@lru_cache(maxsize=None)
+def trade_row_type(fields):
+    return namedtuple('TradeRow', fields)
+
+def _read_partition(path, fields, start=None, end=None):
+    if pa is None:
+        raise RuntimeError('pyarrow is required to read archived trades')
+    # Memory-mapped, and only the requested columns are decompressed
+    table = feather.read_table(path, columns=list(fields), memory_map=True)
+    if start is not None:
+        table = table.filter(pc.field('open_time') >= pa.scalar(start, pa.timestamp('us')))
+    if end is not None:
+        table = table.filter(pc.field('open_time') <= pa.scalar(end, pa.timestamp('us')))
+    return table
+
+def get_partitions(user_id, start=None, end=None):
+    query = TradeArchivePartition.query.filter_by(user_id=user_id)
+    if start is not None:
+        query = query.filter(TradeArchivePartition.last_open_time >= start)
+    if end is not None:
+        query = query.filter(TradeArchivePartition.first_open_time <= end)
+    return query.order_by(TradeArchivePartition.year).all()
+
+# A user's trades in (open_time, id) order, reading the archived partitions that overlap [start, end]
+# alongside the live table, so analytics see the full history wherever a trade is stored.
+def trade_rows(user_id, columns, start=None, end=None):
+    fields = tuple(dict.fromkeys(('open_time', 'id') + tuple(columns)))
+    row_type = trade_row_type(fields)
+    query = db.session.query(*(getattr(Trade, field) for field in fields)).filter(Trade.user_id == user_id)
+    if start is not None:
+        query = query.filter(Trade.open_time >= start)
+    if end is not None:
+        query = query.filter(Trade.open_time <= end)
+    live = [row_type(*row) for row in query.order_by(Trade.open_time, Trade.id)]
+
+    partitions = get_partitions(user_id, start, end)
+    if not partitions:
+        return live
+    archived = []
+    for partition in partitions:
+        table = _read_partition(_partition_path(user_id, partition.year), fields, start, end)
+        archived.extend(map(row_type, *(table.column(field).to_pylist() for field in fields)))
+    return list(heapq.merge(archived, live, key=lambda row: (row.open_time, row.id)))
+
+# The tickets among the given ones that belong to archived trades of the user. Archived trades are
+# read-only, so pushes and entries of these tickets must not add a second copy to the live table.
+def archived_tickets(user_id, tickets):
+    tickets = set(tickets)
+    found = set()
+    if not tickets:
+        return found
+    for partition in get_partitions(user_id):
+        table = _read_partition(_partition_path(user_id, partition.year), ('ticket',))
+        found.update(tickets.intersection(table.column('ticket').to_pylist()))
+    return found
+
+# Net profit of a user's archived trades, from the partition summaries.
+def archived_profit(user_id):
+    return db.session.query(db.func.coalesce(db.func.sum(TradeArchivePartition.profit), 0)).filter_by(user_id=user_id).scalar()
+
+# Merge the new rows into the user's partition of the year and write the result next to it as a staged
+# file; _publish_partitions moves it into place once the deletion of the live rows is committed.
+def _write_partition(user_id, year, table):
+    path = _partition_path(user_id, year)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        stored = feather.read_table(path, memory_map=True)
+        # Partitions written before a column was added get it as nulls, and before the prices were
+        # widened to five decimals get them rescaled
+        for field in table.schema:
+            if field.name not in stored.column_names:
+                stored = stored.append_column(field, pa.nulls(stored.num_rows, field.type))
+        table = pa.concat_tables([stored.select(table.column_names).cast(table.schema), table])
+        # A trade already in the stored partition keeps a single copy
+        last = {trade_id: index for index, trade_id in enumerate(table.column('id').to_pylist())}
+        table = table.take(sorted(last.values()))
+    table = table.sort_by([('open_time', 'ascending'), ('id', 'ascending')])
+    # Write then rename, so a staged file is never half-written
+    feather.write_feather(table, path + '.tmp', compression='zstd')
+    os.replace(path + '.tmp', path + '.staged')
+    return table
+
+# Move the user's staged partitions into place. A staged file whose row count is not the one committed
+# to its partition summary belongs to an archival that was rolled back, and is dropped.
+def _publish_partitions(user_id):
+    folder = os.path.dirname(_partition_path(user_id, 0))
+    if not os.path.isdir(folder):
+        return
+    counts = dict(db.session.query(TradeArchivePartition.year, TradeArchivePartition.trades).filter_by(user_id=user_id))
+    for name in os.listdir(folder):
+        if not name.endswith('.arrow.staged'):
+            continue
+        staged = os.path.join(folder, name)
+        year = int(name.split('.')[0])
+        if counts.get(year) == feather.read_table(staged, columns=['id'], memory_map=True).num_rows:
+            os.replace(staged, _partition_path(user_id, year))
+        else:
+            os.remove(staged)
+
+def _update_partition(user_id, year, table):
+    partition = TradeArchivePartition.query.filter_by(user_id=user_id, year=year).first()
+    if not partition:
+        partition = TradeArchivePartition(user_id=user_id, year=year)
+        db.session.add(partition)
+    open_times = table.column('open_time')
+    partition.trades = table.num_rows
+    partition.profit = pc.sum(table.column('profit')).as_py() or Decimal(0)
+    partition.first_open_time = pc.min(open_times).as_py()
+    partition.last_open_time = pc.max(open_times).as_py()
+    partition.archived_at = datetime.utcnow()
+
+# Move a user's trades opened before cutoff into per-year compressed Arrow partitions and delete them
+# from the live table. The rollups, the rule state and the equity are left as they are: they already
+# count these trades. Returns the number of trades archived.
+def archive_user_trades(user_id, cutoff):
+    # Locking the account row holds back the user's trade writes, so the rows deleted are the rows archived
+    UserData.query.filter_by(user_id=user_id).with_for_update().first()
+    _publish_partitions(user_id)
+    first = db.session.query(db.func.min(Trade.open_time)).filter(Trade.user_id == user_id, Trade.open_time < cutoff).scalar()
+    if first is None:
+        db.session.commit()
+        return 0
+    schema = _schema()
+    archived = 0
+    # One year at a time, and only the archived columns, so a long history is never held in memory at once
+    for year in range(first.year, cutoff.year + 1):
+        start, end = datetime(year, 1, 1), min(datetime(year + 1, 1, 1), cutoff)
+        in_year = (Trade.user_id == user_id, Trade.open_time >= start, Trade.open_time < end)
+        rows = db.session.query(*(getattr(Trade, column) for column in ARCHIVE_COLUMNS)).filter(*in_year).order_by(Trade.open_time, Trade.id).all()
+        if not rows:
+            continue
+        table = pa.table(dict(zip(ARCHIVE_COLUMNS, map(list, zip(*rows)))), schema=schema)
+        _update_partition(user_id, year, _write_partition(user_id, year, table))
+        Trade.query.filter(*in_year).delete(synchronize_session=False)
+        archived += len(rows)
+    # Published after the commit, so a failed commit leaves the trades in the live table only
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        _publish_partitions(user_id)
+        raise
+    _publish_partitions(user_id)
+    return archived
+
+# Archive every user's trades older than ARCHIVE_AFTER_DAYS (or only user_id's).
+def archive_old_trades(user_id=None):
+    if pa is None:
+        logging.warning('pyarrow is not installed, skipping trade archival')
+        return 0
+    cutoff = datetime.utcnow() - timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])
+    if user_id is not None:
+        user_ids = [user_id]
+    else:
+        user_ids = [uid for (uid,) in db.session.query(Trade.user_id).filter(Trade.open_time < cutoff).distinct()]
+    return sum(archive_user_trades(uid, cutoff) for uid in user_ids)
+
+# Add a user's archived trades back into freshly rebuilt rollup tables.
+def add_archive_to_rollups(user_id):
+    fields = ('open_time', 'id', 'size', 'profit', 'item', 'strategy', 'trade_type')
+    changes = []
+    for partition in get_partitions(user_id):
+        table = _read_partition(_partition_path(user_id, partition.year), fields)
+        for open_time, trade_id, size, profit, item, strategy, trade_type in zip(*(table.column(field).to_pylist() for field in fields)):
+            changes.append((None, TradeSnapshot(trade_id, user_id, open_time, size, profit, item, strategy or '', trade_type)))
+    if changes:
+        apply_trade_changes(changes)
+
+# Delete a user's archived partitions (used by the account reset).
+def clear_archive(user_id):
+    for partition in TradeArchivePartition.query.filter_by(user_id=user_id).all():
+        path = _partition_path(user_id, partition.year)
+        if os.path.exists(path):
+            os.remove(path)
+        db.session.delete(partition)
@@ -0,0 +1,203 @@
+import csv
+import logging
+import os
+import re
+import numpy as np
+from sqlalchemy import update
+from tradepilot import app, db
+from tradepilot.ingest import parse_trade_time
+from tradepilot.models import Trade
+
+# One bar per record, bar open time in UTC epoch seconds. Files are raw arrays of these records sorted
+# by time, so the n-th bar is at byte n * BAR_DTYPE.itemsize and the time column can be binary searched
+# straight off the memory map.
+BAR_DTYPE = np.dtype([('time', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8')])
+EXCURSION_BATCH = 1000  # trades per vectorized step, bounding the bars copied to the ones these trades span
+
+_bar_maps = {}
+
+# File name of an instrument's bars: the symbol upper-cased without punctuation, so "eur/usd" and "EURUSD" share one.
+def bar_symbol(item):
+    return re.sub(r'[^A-Z0-9]', '', (item or '').upper())
+
+def _bar_path(symbol):
+    return os.path.join(app.config['BAR_FOLDER'], f'{symbol}.bars')
+
+def bar_symbols():
+    folder = app.config['BAR_FOLDER']
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name[:-len('.bars')] for name in os.listdir(folder) if name.endswith('.bars'))
+
+# An instrument's bars, memory-mapped read-only, or None when there are none. The map is reused until
+# the file is replaced by a new load.
+def open_bars(symbol):
+    path = _bar_path(symbol)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if not stat.st_size:
+        return None
+    cached = _bar_maps.get(path)
+    if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    bars = np.memmap(path, dtype=BAR_DTYPE, mode='r')
+    _bar_maps[path] = ((stat.st_mtime_ns, stat.st_size), bars)
+    return bars
+
+def _epoch_seconds(moments):
+    return np.asarray(moments, dtype='datetime64[s]').astype(np.int64)
+
+def _read_rows(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        return [row for row in csv.reader(f, dialect) if row]
+
+def _is_number(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+# Column names of a bar export. MetaTrader exports either have a <DATE> <TIME> <OPEN>... header or none
+# at all (date, time, open, high, low, close[, volume]); other exports name a time (or date) column.
+def _columns(rows):
+    first = rows[0]
+    if not _is_number(first[-1]):
+        return [re.sub(r'[<>\s]', '', name).lower() for name in first], rows[1:]
+    if ':' in first[1]:
+        return ['date', 'time', 'open', 'high', 'low', 'close'], rows
+    return ['time', 'open', 'high', 'low', 'close'], rows
+
+def _parse_times(texts):
+    texts = [text.strip() for text in texts]
+    if all(text.isdigit() for text in texts):
+        seconds = np.array(texts, dtype=np.int64)
+        return np.where(seconds > 10 ** 11, seconds // 1000, seconds)  # Millisecond timestamps
+    try:
+        # MetaTrader writes dates as 2024.03.04
+        return _epoch_seconds([re.sub(r'^(\d{4})\.(\d{2})\.(\d{2})', r'\1-\2-\3', text) for text in texts])
+    except ValueError:
+        return _epoch_seconds([parse_trade_time(text) for text in texts])
+
+# Parse a CSV export of OHLC bars (times in UTC) into a record array sorted by time. Raises ValueError.
+def parse_bars(path):
+    rows = _read_rows(path)
+    if not rows:
+        return np.empty(0, dtype=BAR_DTYPE)
+    names, rows = _columns(rows)
+    index = {name: position for position, name in enumerate(names)}
+    missing = [name for name in ('open', 'high', 'low', 'close') if name not in index]
+    if missing or not ({'time', 'date', 'datetime'} & set(index)):
+        raise ValueError(f'Bar export needs time, open, high, low and close columns, got {names}')
+    if 'date' in index and 'time' in index:
+        texts = [f"{row[index['date']]} {row[index['time']]}" for row in rows]
+    else:
+        column = index.get('time', index.get('datetime', index.get('date')))
+        texts = [row[column] for row in rows]
+
+    bars = np.empty(len(rows), dtype=BAR_DTYPE)
+    try:
+        bars['time'] = _parse_times(texts)
+        for name in ('open', 'high', 'low', 'close'):
+            bars[name] = [float(row[index[name]]) for row in rows]
+    except (IndexError, OverflowError) as e:
+        raise ValueError(f'Malformed bar export: {e}')
+    return bars[np.argsort(bars['time'], kind='stable')]
+
+# Merge a CSV export into an instrument's bar file. Bars already stored at the same time are replaced
+# by the loaded ones, so overlapping exports can be loaded in any order.
+def load_bars(item, path):
+    symbol = bar_symbol(item)
+    if not symbol:
+        raise ValueError('An instrument symbol is required')
+    loaded = parse_bars(path)
+    stored = open_bars(symbol)
+    bars = loaded if stored is None else np.concatenate([loaded, stored])
+    # np.unique keeps the first of equal times, which is the loaded bar
+    _, first = np.unique(bars['time'], return_index=True)
+    bars = bars[first]
+
+    target = _bar_path(symbol)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # Write then rename, so a map open elsewhere keeps the old file and readers never see a partial one
+    bars.tofile(target + '.tmp')
+    os.replace(target + '.tmp', target)
+    logging.info('Loaded %d bars into %s (%d stored)', len(loaded), symbol, len(bars))
+    return {'symbol': symbol, 'loaded': len(loaded), 'bars': len(bars)}
+
+# Highest high and lowest low over the bars each trade was open in, from the bar it opened in through
+# the last bar that opened before it closed. Each trade's bars are found with two binary searches on the
+# time column, and the extremes of all the slices are taken with a single reduceat per column.
+def bar_extremes(bars, opens, closes):
+    times = bars['time']
+    lefts = np.maximum(np.searchsorted(times, opens, side='right') - 1, 0)
+    rights = np.maximum(np.searchsorted(times, closes, side='right'), lefts + 1)
+    low, high = int(lefts.min()), int(rights.max())
+    # reduceat reduces [bounds[i], bounds[i + 1]); the even positions are the trades' slices, and the
+    # padding keeps the last bound a valid index
+    bounds = np.empty(2 * len(lefts), dtype=np.int64)
+    bounds[0::2] = lefts - low
+    bounds[1::2] = rights - low
+    highs = np.maximum.reduceat(np.append(bars['high'][low:high], 0.0), bounds)[0::2]
+    lows = np.minimum.reduceat(np.append(bars['low'][low:high], 0.0), bounds)[0::2]
+    return highs, lows
+
+# Maximum adverse and favourable excursion, in price like pips: how far price went against and for
+# each trade from its entry while it was open.
+def excursions(bars, opens, closes, prices, buys):
+    highs, lows = bar_extremes(bars, opens, closes)
+    up = np.maximum(highs - prices, 0)
+    down = np.maximum(prices - lows, 0)
+    return np.where(buys, down, up), np.where(buys, up, down)
+
+# Trade items grouped by the bar file they read, for the trades still missing excursions unless recompute.
+def _items_by_symbol(user_id, recompute):
+    query = db.session.query(Trade.item)
+    if user_id is not None:
+        query = query.filter(Trade.user_id == user_id)
+    if not recompute:
+        query = query.filter(Trade.mae.is_(None))
+    items = {}
+    for (item,) in query.distinct():
+        items.setdefault(bar_symbol(item), []).append(item)
+    return items
+
+# Store MAE and MFE on every trade that doesn't have them yet and whose whole life is covered by its
+# instrument's bars (or on all covered trades, with recompute). Trades are read and updated in bulk,
+# one instrument at a time.
+def compute_excursions(user_id=None, symbols=None, recompute=False):
+    items = _items_by_symbol(user_id, recompute)
+    updated = 0
+    for symbol in symbols or bar_symbols():
+        bars = open_bars(symbol)
+        if bars is None or symbol not in items:
+            continue
+        first, last = (np.datetime64(int(bars['time'][index]), 's').astype(object) for index in (0, -1))
+        query = db.session.query(Trade.id, Trade.open_time, Trade.close_time, Trade.price, Trade.trade_type) \
+            .filter(Trade.item.in_(items[symbol]), Trade.open_time >= first, Trade.close_time <= last) \
+            .order_by(Trade.open_time)
+        if user_id is not None:
+            query = query.filter(Trade.user_id == user_id)
+        if not recompute:
+            query = query.filter(Trade.mae.is_(None))
+        trades = query.all()
+        for start in range(0, len(trades), EXCURSION_BATCH):
+            batch = trades[start:start + EXCURSION_BATCH]
+            mae, mfe = excursions(bars,
+                                  _epoch_seconds([trade.open_time for trade in batch]),
+                                  _epoch_seconds([trade.close_time for trade in batch]),
+                                  np.array([float(trade.price) for trade in batch]),
+                                  np.array([trade.trade_type.lower() == 'buy' for trade in batch]))
+            db.session.execute(update(Trade), [{'id': trade.id, 'mae': float(adverse), 'mfe': float(favourable)}
+                                               for trade, adverse, favourable in zip(batch, mae, mfe)])
+            db.session.commit()
+            updated += len(batch)
+    return updated
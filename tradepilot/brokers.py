@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime
+from decimal import Decimal
+import aiohttp
+import redis
+from redis.exceptions import LockError
+from sqlalchemy import update
+from tradepilot import app, db
+from tradepilot.models import UserData
+
+logger = logging.getLogger(__name__)
+
+# Redis lock held while a sweep runs. A sweep of many accounts can outlast the beat interval (10k
+# DxTrade accounts at 20 requests a second take about 500 s), and a beat firing meanwhile is skipped.
+SYNC_LOCK = 'tradepilot:broker-sync'
+
+# Raised for responses that are worth retrying (rate limited, server errors).
+class RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Token bucket shared by every request of one adapter: at most `rate` requests per second with
+# bursts of up to `burst`.
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Base class of the broker adapters. An adapter knows how to ask its platform's API for one account's
+# balance and equity; polling, pooling, rate limiting, timeouts and retries are shared here.
+class BrokerAdapter:
+    platform = None
+    rate_limit = 50  # requests per second
+    max_connections = 50  # pooled connections to the API
+    timeout = 5  # seconds per request
+    retries = 3
+    backoff = 0.5  # seconds, doubled on every retry
+
+    def __init__(self, base_url, token=None):
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.limiter = RateLimiter(self.rate_limit)
+
+    def headers(self):
+        return {'Authorization': f'Bearer {self.token}'} if self.token else {}
+
+    # Path of the account endpoint relative to base_url.
+    def account_path(self, account):
+        raise NotImplementedError
+
+    # Pull (balance, equity) out of the API response.
+    def parse(self, payload):
+        raise NotImplementedError
+
+    async def _get(self, session, account):
+        await self.limiter.acquire()
+        async with session.get(self.base_url + self.account_path(account), headers=self.headers()) as response:
+            if response.status == 429 or response.status >= 500:
+                retry_after = response.headers.get('Retry-After')
+                raise RetryableError(f'HTTP {response.status}', float(retry_after) if retry_after and retry_after.isdigit() else None)
+            response.raise_for_status()
+            return self.parse(await response.json())
+
+    # Fetch one account, retrying timeouts, connection errors, 429s and 5xx with exponential backoff
+    # and jitter. Returns None when the account could not be fetched.
+    async def fetch(self, session, account):
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._get(session, account)
+            except (RetryableError, asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                if attempt == self.retries:
+                    logger.warning('%s account %s failed after %d attempts: %s', self.platform, account, attempt + 1, e)
+                    return None
+                delay = getattr(e, 'retry_after', None) or self.backoff * 2 ** attempt
+                await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            except (aiohttp.ClientError, KeyError, TypeError, ValueError) as e:
+                logger.warning('%s account %s failed: %s', self.platform, account, e)
+                return None
+
+    def session(self):
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections),
+                                     timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+# MetaTrader accounts are read through a MetaTrader web API bridge.
+class MT4Adapter(BrokerAdapter):
+    platform = 'MT4'
+
+    def account_path(self, account):
+        return f'/accounts/{account}'
+
+    def parse(self, payload):
+        return Decimal(str(payload['balance'])), Decimal(str(payload['equity']))
+
+class MT5Adapter(MT4Adapter):
+    platform = 'MT5'
+
+class DxTradeAdapter(BrokerAdapter):
+    platform = 'DxTrade'
+    rate_limit = 20
+
+    def account_path(self, account):
+        return f'/dxsca-web/accounts/{account}/metrics'
+
+    def parse(self, payload):
+        metrics = payload['metrics'][0]
+        return Decimal(str(metrics['balance'])), Decimal(str(metrics['equity']))
+
+# cTrader reports money as integers scaled by 10 ** moneyDigits.
+class CtraderAdapter(BrokerAdapter):
+    platform = 'Ctrader'
+    rate_limit = 30
+
+    def account_path(self, account):
+        return f'/v2/tradingaccounts/{account}'
+
+    def parse(self, payload):
+        scale = Decimal(10) ** int(payload.get('moneyDigits', 2))
+        return Decimal(payload['balance']) / scale, Decimal(payload['equity']) / scale
+
+ADAPTERS = {adapter.platform: adapter for adapter in (MT4Adapter, MT5Adapter, DxTradeAdapter, CtraderAdapter)}
+
+# Build an adapter for every platform that has an API URL configured.
+def configured_adapters():
+    adapters = {}
+    for platform, settings in app.config['BROKER_APIS'].items():
+        if platform in ADAPTERS and settings.get('url'):
+            adapters[platform] = ADAPTERS[platform](settings['url'], settings.get('token'))
+    return adapters
+
+async def _poll_platform(adapter, accounts):
+    async with adapter.session() as session:
+        results = await asyncio.gather(*(adapter.fetch(session, account) for _, account in accounts))
+    return [(user_data_id, result) for (user_data_id, _), result in zip(accounts, results) if result is not None]
+
+# Poll every (user_data_id, account) of every platform concurrently. Each platform gets its own
+# connection pool and rate limiter so one slow broker API does not hold up the others.
+async def poll_accounts(adapters, accounts_by_platform):
+    batches = await asyncio.gather(*(_poll_platform(adapters[platform], accounts)
+                                     for platform, accounts in accounts_by_platform.items()))
+    return [row for batch in batches for row in batch]
+
+# Fetch the balance and equity of every linked account and write them back with one bulk UPDATE.
+# Returns the number of accounts updated.
+def sync_all_accounts():
+    adapters = configured_adapters()
+    if not adapters:
+        return 0
+    rows = db.session.query(UserData.id, UserData.platform, UserData.broker_account) \
+        .filter(UserData.platform.in_(list(adapters)), UserData.broker_account.isnot(None), UserData.broker_account != '').all()
+    accounts_by_platform = {}
+    for user_data_id, platform, account in rows:
+        accounts_by_platform.setdefault(platform, []).append((user_data_id, account))
+    if not accounts_by_platform:
+        return 0
+
+    results = asyncio.run(poll_accounts(adapters, accounts_by_platform))
+    if results:
+        synced_at = datetime.utcnow()
+        db.session.execute(update(UserData), [
+            {'id': user_data_id, 'balance': balance, 'equity': equity, 'last_synced_at': synced_at}
+            for user_data_id, (balance, equity) in results
+        ])
+        db.session.commit()
+    return len(results)
+
+# Run sync_all_accounts unless the previous sweep is still going. Returns the number of accounts
+# updated, or None when skipped.
+def sync_all_accounts_exclusive():
+    lock = redis.Redis.from_url(app.config['broker_url']).lock(SYNC_LOCK, timeout=app.config['BROKER_SYNC_LOCK_TIMEOUT'])
+    if not lock.acquire(blocking=False):
+        logger.info('Previous broker sync is still running, skipping this one')
+        return None
+    try:
+        return sync_all_accounts()
+    finally:
+        try:
+            lock.release()
+        except LockError:  # Outlived the timeout and expired
+            pass
@@ -0,0 +1,172 @@
+from itertools import product
+import numpy as np
+from tradepilot.rules import parse_count, parse_limit
+from tradepilot.trade_cache import cached_trade_rows
+
+# Day-scoped limits that can be replayed. Each one ends the trading day once it is hit, so the trades
+# a set of limits lets through on a day are always a prefix of that day's trades.
+RULE_PARAMETERS = ('trades_per_day', 'consecutive_losers', 'daily_max_loss')
+MAX_GRID_VALUES = 50
+MAX_COMBINATIONS = 5000
+COMBINATION_BATCH = 500  # combinations evaluated per vectorized step, bounding memory to batch x days
+NO_LIMIT_VALUES = ('', 'none', 'off', '-')
+DEFAULT_GRID = {
+    'trades_per_day': [1, 2, 3, 4, 5, None],
+    'consecutive_losers': [1, 2, 3, 4, None],
+    'daily_max_loss': ['1%', '2%', '3%', '5%', None],
+}
+
+# A user's trades laid out as a days x trades-per-day matrix, with the running totals every limit
+# is checked against precomputed along each day.
+class DayMatrix:
+    __slots__ = ('days', 'lengths', 'pnl', 'gains', 'losses', 'wins', 'streak')
+
+    def __init__(self, rows):
+        dates = [row.open_time.date() for row in rows]
+        self.days, starts, lengths = np.unique(np.array(dates, dtype='datetime64[D]'), return_index=True, return_counts=True)
+        self.lengths = lengths
+        width = int(lengths.max()) if len(rows) else 0
+        day_index = np.repeat(np.arange(len(self.days)), lengths)
+        position = np.arange(len(rows)) - np.repeat(starts, lengths)
+        profits = np.zeros((len(self.days), width))
+        profits[day_index, position] = [float(row.profit) for row in rows]
+        taken = np.zeros((len(self.days), width), dtype=bool)
+        taken[day_index, position] = True
+
+        # Totals after the first k trades of each day, k = 0..width
+        self.pnl = self._prefix(profits)
+        self.gains = self._prefix(np.where(profits > 0, profits, 0))
+        self.losses = self._prefix(np.where(taken & (profits <= 0), -profits, 0))
+        self.wins = self._prefix((profits > 0).astype(np.int64))
+        # Length of the losing streak ending at each trade, counted from the start of its day
+        losing = taken & (profits <= 0)
+        columns = np.arange(width)
+        last_reset = np.maximum.accumulate(np.where(losing, -1, columns), axis=1) if width else np.zeros((len(self.days), 0), dtype=np.int64)
+        self.streak = np.where(losing, columns - last_reset, 0)
+
+    @staticmethod
+    def _prefix(values):
+        totals = np.zeros((values.shape[0], values.shape[1] + 1), dtype=values.dtype)
+        np.cumsum(values, axis=1, out=totals[:, 1:])
+        return totals
+
+    # Trades taken on each day before the first trade at which hit is true, that trade included.
+    def _first_stop(self, hit):
+        if not hit.size:
+            return self.lengths.copy()
+        stop = np.where(hit.any(axis=1), hit.argmax(axis=1) + 1, self.lengths)
+        return np.minimum(stop, self.lengths)
+
+    def stop_after_losers(self, count):
+        return self.lengths.copy() if count is None else self._first_stop(self.streak >= count)
+
+    def stop_after_loss(self, amount):
+        return self.lengths.copy() if amount is None else self._first_stop(self.pnl[:, 1:] <= -amount)
+
+# Parse ?trades_per_day=1,2,3&daily_max_loss=1%,2%,none style arguments into the values to try per
+# limit, None meaning no limit. Limits left out use DEFAULT_GRID; money amounts may be percentages
+# of balance. Raises ValueError.
+def parse_grid_args(args, balance):
+    grid = {}
+    for parameter in RULE_PARAMETERS:
+        texts = args.get(parameter)
+        if texts:
+            texts = [text.strip() for text in texts.split(',')]
+        elif parameter == 'daily_max_loss' and not balance:
+            texts = [None]  # The default loss limits are percentages of balance
+        else:
+            texts = DEFAULT_GRID[parameter]
+        values = []
+        for text in texts:
+            if text is None or str(text).lower() in NO_LIMIT_VALUES:
+                value = None
+            elif parameter == 'daily_max_loss':
+                value = parse_limit(text, balance)
+                if value is None:
+                    raise ValueError(f'{parameter} values must be amounts or percentages of balance, got {text!r}')
+                value = float(value)
+            else:
+                value = parse_count(text)
+                if value is None:
+                    raise ValueError(f'{parameter} values must be positive whole numbers, got {text!r}')
+            if value not in values:
+                values.append(value)
+        if len(values) > MAX_GRID_VALUES:
+            raise ValueError(f'At most {MAX_GRID_VALUES} values per limit')
+        grid[parameter] = values
+    combinations = 1
+    for values in grid.values():
+        combinations *= len(values)
+    if combinations > MAX_COMBINATIONS:
+        raise ValueError(f'The grid has {combinations} combinations; at most {MAX_COMBINATIONS} are allowed')
+    return grid
+
+# The user's own limits from their rule state, in grid form. Of the two daily loss limits the
+# tighter one applies.
+def own_limits(state):
+    if state is None:
+        return dict.fromkeys(RULE_PARAMETERS)
+    day_limits = [float(limit) for limit in (state.daily_max_loss, state.max_daily_loss) if limit]
+    return {'trades_per_day': state.trades_per_day, 'consecutive_losers': state.consecutive_losers,
+            'daily_max_loss': min(day_limits) if day_limits else None}
+
+# Evaluate every combination of limits over the matrix. Per limit value, the trades each day keeps
+# are computed once; a combination keeps the shortest of its limits' prefixes, and its daily P&L,
+# equity curve and statistics are read off the precomputed prefix totals, a batch of combinations
+# at a time.
+def evaluate_grid(matrix, combinations):
+    by_losers = {count: matrix.stop_after_losers(count) for count in {combo[1] for combo in combinations}}
+    by_loss = {amount: matrix.stop_after_loss(amount) for amount in {combo[2] for combo in combinations}}
+    day_rows = np.arange(len(matrix.days))[None, :]
+    results = []
+    for start in range(0, len(combinations), COMBINATION_BATCH):
+        batch = combinations[start:start + COMBINATION_BATCH]
+        stop = np.stack([np.minimum(by_losers[losers], by_loss[loss]) for trades, losers, loss in batch])
+        limits = np.array([trades if trades is not None else np.iinfo(np.int64).max for trades, losers, loss in batch])
+        stop = np.minimum(stop, limits[:, None])
+        day_pnl = matrix.pnl[day_rows, stop]
+        equity = np.cumsum(day_pnl, axis=1)
+        drawdown = (np.maximum.accumulate(np.maximum(equity, 0), axis=1) - equity).max(axis=1, initial=0)
+        trades = stop.sum(axis=1)
+        wins = matrix.wins[day_rows, stop].sum(axis=1)
+        gains = matrix.gains[day_rows, stop].sum(axis=1)
+        losses = matrix.losses[day_rows, stop].sum(axis=1)
+        for index, combo in enumerate(batch):
+            results.append({
+                'trades_per_day': combo[0],
+                'consecutive_losers': combo[1],
+                'daily_max_loss': combo[2],
+                'trades': int(trades[index]),
+                'net_profit': float(equity[index, -1]) if equity.shape[1] else 0.0,
+                'max_drawdown': float(drawdown[index]),
+                'win_rate': float(wins[index] / trades[index] * 100) if trades[index] else 0.0,
+                'profit_factor': float(gains[index] / losses[index]) if losses[index] > 0 else 0.0,
+                'equity': equity[index],
+            })
+    return results
+
+def _curve(result):
+    return [round(float(value), 2) for value in result.pop('equity')]
+
+# What-if replay of a user's journal under their own day limits and under every combination of grid.
+# Returns the actual and own-limits results with their daily equity curves, and the grid results
+# best net profit first, the best one with its curve too.
+def replay_limits(user_id, state, grid, top=50):
+    matrix = DayMatrix(cached_trade_rows(user_id, ('profit',)))
+    own = own_limits(state)
+    combinations = list(product(*(grid[parameter] for parameter in RULE_PARAMETERS)))
+    actual, mine = evaluate_grid(matrix, [(None, None, None), tuple(own[parameter] for parameter in RULE_PARAMETERS)])
+    results = evaluate_grid(matrix, combinations)
+    results.sort(key=lambda result: (-result['net_profit'], result['max_drawdown']))
+    best = results[0] if results else None
+    curves = {'actual': _curve(actual), 'own': _curve(mine), 'best': _curve(best) if best else []}
+    for result in results[1:top]:
+        result.pop('equity')
+    return {
+        'days': [str(day) for day in matrix.days],
+        'actual': actual,
+        'own': mine,
+        'combinations': len(combinations),
+        'results': results[:top],
+        'curves': curves,
+    }
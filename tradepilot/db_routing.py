@@ -0,0 +1,64 @@
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, has_request_context, session as flask_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+# Bind key of the read replica in SQLALCHEMY_BINDS.
+REPLICA_BIND = 'replica'
+
+# Session that sends reads to the replica engine while use_replica() is active. Flushes and
+# INSERT/UPDATE/DELETE statements always go to the primary, and once a session has written it
+# stays on the primary so later reads in the same request see those writes.
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or isinstance(clause, UpdateBase):
+                self.info['has_written'] = True
+            elif self.info.get('use_replica') and not self.info.get('has_written'):
+                replica = self._db.engines.get(REPLICA_BIND)
+                if replica is not None:
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    # Outside a request (Celery tasks), writes that are committed or rolled back no longer keep the
+    # session on the primary; tasks compare the replica's data version with the primary's instead.
+    def commit(self):
+        super().commit()
+        if not has_request_context():
+            self.info['has_written'] = False
+
+    def rollback(self):
+        super().rollback()
+        if not has_request_context():
+            self.info['has_written'] = False
+
+# Remember in the user's session that they just wrote, so the read-only pages they are redirected to
+# keep reading from the primary until the replica has had time to catch up.
+def mark_recent_write():
+    if has_request_context():
+        flask_session['primary_until'] = time.time() + current_app.config['READ_YOUR_WRITES_SECONDS']
+
+def _recently_wrote():
+    return has_request_context() and flask_session.get('primary_until', 0) > time.time()
+
+# Route the reads of the enclosed block to the replica.
+@contextmanager
+def use_replica():
+    from tradepilot import db
+    info = db.session().info
+    previous = info.get('use_replica', False)
+    info['use_replica'] = not _recently_wrote()
+    try:
+        yield
+    finally:
+        info['use_replica'] = previous
+
+# Decorator for read-only views and Celery analytics tasks.
+def read_only(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with use_replica():
+            return func(*args, **kwargs)
+    return wrapper
@@ -2,7 +2,8 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, BooleanField, DateTimeField, IntegerField, DecimalField, SelectField, TextAreaField, FileField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, NumberRange, ValidationError, Optional
 from flask_wtf.file import FileField, FileAllowed
-from tradepilot.models import ChecklistCategory, User
+from tradepilot.archive import archived_tickets
+from tradepilot.models import ChecklistCategory, Trade, User
 from flask_login import current_user
 
 
@@ -53,6 +54,7 @@ class UpdateProfileForm(FlaskForm):
 class UserDataForm(FlaskForm):
     broker_name = StringField('Broker Name', validators=[DataRequired()])
     platform = SelectField('Platform', choices=[('MT4', 'MT4'), ('MT5', 'MT5'), ('DxTrade', 'DxTrade'), ('Ctrader', 'Ctrader')], validators=[DataRequired()])
+    broker_account = StringField('Account Number', validators=[Optional(), Length(max=100)])
     equity = DecimalField('Equity', validators=[DataRequired(), NumberRange(min=0)], places=2)
     balance = DecimalField('Balance', validators=[DataRequired(), NumberRange(min=0)], places=2)
     min_trading_days = IntegerField('Minimum Trading Days', validators=[DataRequired()])
@@ -75,11 +77,11 @@ class TradeForm(FlaskForm):
     trade_type = SelectField('Trade Type', choices=[('Buy', 'Buy'), ('Sell', 'Sell')], validators=[DataRequired()])
     size = DecimalField('Size', validators=[DataRequired(), NumberRange(min=0, max=1000000)], places=2)
     item = StringField('Item', validators=[DataRequired()])
-    price = DecimalField('Price', validators=[DataRequired(), NumberRange(min=0, max=1000000)], places=2)
-    s_l = DecimalField('S / L', validators=[Optional(), NumberRange(min=0, max=1000000)], places=2)
-    t_p = DecimalField('T / P', validators=[Optional(), NumberRange(min=0, max=1000000)], places=2)
+    price = DecimalField('Price', validators=[DataRequired(), NumberRange(min=0, max=1000000)], places=5)
+    s_l = DecimalField('S / L', validators=[Optional(), NumberRange(min=0, max=1000000)], places=5)
+    t_p = DecimalField('T / P', validators=[Optional(), NumberRange(min=0, max=1000000)], places=5)
     close_time = DateTimeField('Close Time', format='%Y-%m-%d %H:%M:%S', validators=[Optional()])
-    close_price = DecimalField('Close Price', validators=[Optional(), NumberRange(min=0, max=1000000)], places=2)
+    close_price = DecimalField('Close Price', validators=[Optional(), NumberRange(min=0, max=1000000)], places=5)
     comm = DecimalField('Comm', default=0.00, validators=[Optional(), NumberRange(min=0, max=1000000)], places=2)
     taxes = DecimalField('Taxes', default=0.00, validators=[Optional(), NumberRange(min=0, max=1000000)], places=2)
     swap = DecimalField('Swap', default=0.00, validators=[Optional(), NumberRange(min=0, max=1000000)], places=2)
@@ -88,6 +90,11 @@ class TradeForm(FlaskForm):
     strategy = StringField('Strategy', validators=[Optional()])
     submit = SubmitField('Add Trade')
 
+    def validate_ticket(form, field):
+        if field.data != field.object_data:
+            if Trade.query.filter_by(user_id=current_user.id, ticket=field.data).first() or archived_tickets(current_user.id, [field.data]):
+                raise ValidationError('A trade with that ticket is already in your journal.')
+
     def validate_close_time(form, field):
         if field.data and field.data < form.open_time.data:
             raise ValidationError('Close Time must be after Open Time')
@@ -101,9 +108,11 @@ class ItemForm(FlaskForm):
     category_id = SelectField('Category', coerce=int, validators=[DataRequired()])
     submit = SubmitField('Add Item')
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, categories=None, **kwargs):
         super(ItemForm, self).__init__(*args, **kwargs)
-        self.category_id.choices = [(category.id, category.name) for category in ChecklistCategory.query.filter_by(user_id=current_user.id).all()]
+        if categories is None:
+            categories = ChecklistCategory.query.filter_by(user_id=current_user.id).all()
+        self.category_id.choices = [(category.id, category.name) for category in categories]
 
 from flask_wtf import FlaskForm
 from wtforms import StringField, TextAreaField, SubmitField
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import logging
+import secrets
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import insert, update
+from tradepilot import app, db
+from tradepilot.archive import archived_tickets
+from tradepilot.models import ApiToken, IngestBatch, Trade, TradeSnapshot, UserData
+from tradepilot.rollups import apply_trade_changes
+from tradepilot.rules import apply_trade_batch_to_rule_state
+
+REQUIRED_FIELDS = ('ticket', 'open_time', 'close_time', 'trade_type', 'size', 'item', 'price', 'close_price', 'profit')
+MONEY_FIELDS = ('price', 'close_price', 'profit', 's_l', 't_p', 'comm', 'taxes', 'swap')
+PRICE_FIELDS = ('price', 'close_price', 's_l', 't_p')  # Kept to five decimals, the other money fields to two
+# Optional fields default to these on insert and are left untouched on update when a push omits them.
+OPTIONAL_DEFAULTS = {'s_l': Decimal(0), 't_p': Decimal(0), 'comm': Decimal(0), 'taxes': Decimal(0), 'swap': Decimal(0), 'comments': None, 'strategy': None}
+TRADE_TYPES = {'buy': 'Buy', 'sell': 'Sell'}
+SNAPSHOT_FIELDS = ('open_time', 'size', 'profit', 'item', 'strategy', 'trade_type')
+# Changing any of these invalidates a trade's MAE and MFE, which the bar store job then recomputes
+EXCURSION_FIELDS = ('open_time', 'close_time', 'price', 'item', 'trade_type')
+
+# Pending batches older than this are assumed lost and no longer count towards the backpressure limits.
+PENDING_WINDOW = timedelta(minutes=10)
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+# Create an API token for a user. Returns the token itself, which is not stored anywhere.
+def create_api_token(user_id, name):
+    token = 'tp_' + secrets.token_urlsafe(32)
+    db.session.add(ApiToken(user_id=user_id, name=name, token_hash=hash_token(token)))
+    db.session.commit()
+    return token
+
+# Resolve an "Authorization: Bearer <token>" header to its ApiToken, or None.
+def authenticate(header):
+    if not header or not header.startswith('Bearer '):
+        return None
+    api_token = ApiToken.query.filter_by(token_hash=hash_token(header[7:].strip())).first()
+    if api_token and (api_token.last_used_at is None or api_token.last_used_at < datetime.utcnow() - timedelta(minutes=1)):
+        api_token.last_used_at = datetime.utcnow()
+        db.session.commit()
+    return api_token
+
+# Accept ISO 8601 (offsets are converted to UTC), MetaTrader's "2024.03.04 10:00:00" and Unix timestamps.
+def parse_trade_time(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.utcfromtimestamp(value)
+    value = str(value).strip()
+    if len(value) > 7 and value[4] == '.' and value[7] == '.':
+        value = value.replace('.', '-', 2)
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.replace(microsecond=0)
+
+def _parse_money(value, places=2):
+    return Decimal(str(value)).quantize(Decimal(1).scaleb(-places))
+
+# Validate one pushed trade into a JSON-safe dict of normalized values, raising ValueError.
+def validate_trade(item):
+    if not isinstance(item, dict):
+        raise ValueError('trade must be an object')
+    missing = [field for field in REQUIRED_FIELDS if item.get(field) in (None, '')]
+    if missing:
+        raise ValueError('missing ' + ', '.join(missing))
+    row = {'ticket': str(item['ticket'])[:20], 'item': str(item['item'])[:20]}
+    trade_type = TRADE_TYPES.get(str(item['trade_type']).lower())
+    if not trade_type:
+        raise ValueError('trade_type must be Buy or Sell')
+    row['trade_type'] = trade_type
+    try:
+        open_time = parse_trade_time(item['open_time'])
+        close_time = parse_trade_time(item['close_time'])
+    except (ValueError, OverflowError, OSError):
+        raise ValueError('open_time and close_time must be ISO 8601, YYYY.MM.DD HH:MM:SS or Unix timestamps')
+    if close_time < open_time:
+        raise ValueError('close_time is before open_time')
+    row['open_time'] = open_time.isoformat()
+    row['close_time'] = close_time.isoformat()
+    try:
+        row['size'] = float(item['size'])
+        for field in MONEY_FIELDS:
+            if item.get(field) not in (None, ''):
+                row[field] = str(_parse_money(item[field], 5 if field in PRICE_FIELDS else 2))
+    except (InvalidOperation, TypeError, ValueError):
+        raise ValueError('size and prices must be numbers')
+    if row['size'] <= 0:
+        raise ValueError('size must be positive')
+    for field in ('comments', 'strategy'):
+        if item.get(field) is not None:
+            row[field] = str(item[field])[:255] if field == 'strategy' else str(item[field])
+    return row
+
+# Validate a pushed batch. Returns (rows, errors), errors being [{'index': i, 'error': message}].
+def validate_batch(items):
+    rows, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            rows.append(validate_trade(item))
+        except ValueError as e:
+            errors.append({'index': index, 'error': str(e)})
+    return rows, errors
+
+# Seconds a client should wait before pushing again, or None when the queue has room. Limits apply
+# both per user and across all users so that one busy account cannot starve the others.
+def backpressure(user_id):
+    recent = IngestBatch.query.filter(IngestBatch.status == 'pending', IngestBatch.received_at > datetime.utcnow() - PENDING_WINDOW)
+    if recent.filter(IngestBatch.user_id == user_id).count() >= app.config['INGEST_MAX_PENDING_PER_USER'] \
+            or recent.count() >= app.config['INGEST_MAX_PENDING']:
+        return app.config['INGEST_RETRY_AFTER']
+    return None
+
+def queue_batch(user_id, rows):
+    batch = IngestBatch(user_id=user_id, payload=json.dumps(rows), trade_count=len(rows), status='pending')
+    db.session.add(batch)
+    db.session.commit()
+    return batch
+
+# Decode a validated row into column values, deriving pips and duration the way
+# Trade.calculate_pips and Trade.calculate_duration do.
+def trade_values(row):
+    values = {field: row[field] for field in ('ticket', 'item', 'trade_type', 'size')}
+    values['open_time'] = datetime.fromisoformat(row['open_time'])
+    values['close_time'] = datetime.fromisoformat(row['close_time'])
+    for field in MONEY_FIELDS:
+        if field in row:
+            values[field] = Decimal(row[field])
+    for field in ('comments', 'strategy'):
+        if field in row:
+            values[field] = row[field]
+    if values['trade_type'].lower() == 'buy':
+        values['pips'] = values['close_price'] - values['price']
+    else:
+        values['pips'] = values['price'] - values['close_price']
+    values['duration'] = values['close_time'] - values['open_time']
+    return values
+
+def _snapshot(trade_id, user_id, values):
+    return TradeSnapshot(trade_id=trade_id, user_id=user_id, open_time=values['open_time'], size=float(values['size']),
+                         profit=Decimal(values['profit']), item=values['item'], strategy=values.get('strategy') or '',
+                         trade_type=values['trade_type'])
+
+def _apply_batch(batch):
+    user_id = batch.user_id
+    # Later pushes of the same ticket within a batch win
+    rows = {row['ticket']: row for row in json.loads(batch.payload)}
+    # Locking the account row serializes batches of the same user, keeping the upserts and the
+    # equity update free of races between workers
+    user_data = UserData.query.filter_by(user_id=user_id).with_for_update().first()
+    existing = {trade.ticket: trade for trade in Trade.query.filter(Trade.user_id == user_id, Trade.ticket.in_(list(rows)))}
+    # Tickets moved to the archive are read-only: a re-push must not insert them a second time
+    archived = archived_tickets(user_id, set(rows) - set(existing))
+
+    inserts, updates, changes = [], [], []
+    equity_delta = Decimal(0)
+    for ticket, row in rows.items():
+        if ticket in archived:
+            continue
+        values = trade_values(row)
+        trade = existing.get(ticket)
+        if trade is None:
+            inserts.append(dict(OPTIONAL_DEFAULTS, **values, user_id=user_id))
+            equity_delta += values['profit']
+            continue
+        changed = {field: value for field, value in values.items() if getattr(trade, field) != value}
+        if not changed:
+            continue
+        if any(field in changed for field in EXCURSION_FIELDS):
+            changed.update(mae=None, mfe=None)
+        updates.append(dict(changed, id=trade.id))
+        merged = {field: getattr(trade, field) for field in SNAPSHOT_FIELDS}
+        merged.update(changed)
+        changes.append((trade.snapshot(), _snapshot(trade.id, user_id, merged)))
+        equity_delta += values['profit'] - Decimal(trade.profit)
+
+    if inserts:
+        db.session.execute(insert(Trade), inserts)
+        ids = dict(db.session.query(Trade.ticket, Trade.id).filter(Trade.user_id == user_id, Trade.ticket.in_([row['ticket'] for row in inserts])))
+        changes.extend((None, _snapshot(ids[row['ticket']], user_id, row)) for row in inserts)
+    if updates:
+        db.session.execute(update(Trade), updates)
+    if changes:
+        apply_trade_changes(changes)
+        apply_trade_batch_to_rule_state(user_id, changes)
+        version = UserData.bump_data_version(user_id)
+        db.session.execute(update(Trade).where(Trade.id.in_([new.trade_id for old, new in changes])).values(data_version=version))
+    if equity_delta and user_data and not user_data.broker_synced:
+        user_data.equity = Decimal(user_data.equity) + equity_delta
+    return {'inserted': len(inserts), 'updated': len(updates), 'archived': len(archived),
+            'unchanged': len(rows) - len(inserts) - len(updates) - len(archived)}
+
+# Upsert one queued batch on (user_id, ticket) with bulk statements, then bring the rollups, the rule
+# state and the account equity up to date once for the whole batch. Re-running a batch is a no-op.
+def ingest_batch(batch_id):
+    batch = IngestBatch.query.get(batch_id)
+    if not batch or batch.status != 'pending':
+        return
+    try:
+        result = _apply_batch(batch)
+        batch.status = 'done'
+    except Exception as e:
+        logging.exception('Ingest batch %s failed', batch_id)
+        db.session.rollback()
+        batch = IngestBatch.query.get(batch_id)
+        result = {'error': str(e)}
+        batch.status = 'failed'
+    batch.result = json.dumps(result)
+    batch.processed_at = datetime.utcnow()
+    db.session.commit()
+
+def batch_status(batch):
+    status = {'batch_id': batch.id, 'status': batch.status, 'trades': batch.trade_count,
+              'received_at': batch.received_at.isoformat(), 'processed_at': batch.processed_at.isoformat() if batch.processed_at else None}
+    if batch.result:
+        status['result'] = json.loads(batch.result)
+    return status
+
+# Drop processed batches older than the given age.
+def purge_batches(days=7):
+    IngestBatch.query.filter(IngestBatch.status != 'pending', IngestBatch.received_at < datetime.utcnow() - timedelta(days=days)) \
+        .delete(synchronize_session=False)
+    db.session.commit()
@@ -1,10 +1,15 @@
+from collections import namedtuple
 from datetime import datetime, timedelta
+from decimal import Decimal
 from sqlalchemy import DECIMAL, Interval
 from sqlalchemy.dialects.mysql import DECIMAL
 from tradepilot import db, login_manager
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
 
+# Immutable copy of the trade fields the rollup tables are keyed on, taken before and after a write.
+TradeSnapshot = namedtuple('TradeSnapshot', ['trade_id', 'user_id', 'open_time', 'size', 'profit', 'item', 'strategy', 'trade_type'])
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -23,6 +28,7 @@ class UserData(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     broker_name = db.Column(db.String(100), nullable=False)
     platform = db.Column(db.String(50), nullable=False)
+    broker_account = db.Column(db.String(100), nullable=True)  # Account login polled by the broker sync
     equity = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
     balance = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
     min_trading_days = db.Column(db.String(255))
@@ -38,13 +44,36 @@ class UserData(db.Model):
     timeframes = db.Column(db.String(255))
     trades_per_day = db.Column(db.String(255))
     last_update_date = db.Column(db.Date, nullable=False, server_default=db.func.current_date())
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_synced_at = db.Column(db.DateTime, nullable=True)
+
+    # Balance and equity come from the broker sync, which already counts the closed trades' P&L
+    @property
+    def broker_synced(self):
+        return bool(self.broker_account) and self.last_synced_at is not None
 
     def reset_equity(self):
         self.equity = self.balance
         self.last_update_date = datetime.utcnow().date()
         db.session.commit()
 
+    # Bump the counter that per-process caches of a user's trade data are keyed on, returning the new value.
+    @staticmethod
+    def bump_data_version(user_id):
+        UserData.query.filter_by(user_id=user_id).update({UserData.data_version: UserData.data_version + 1})
+        return UserData.get_data_version(user_id)
+
+    @staticmethod
+    def get_data_version(user_id):
+        return db.session.query(UserData.data_version).filter_by(user_id=user_id).scalar() or 0
+
 class Trade(db.Model):
+    # FULLTEXT index used by search on MySQL (SQLite uses the FTS5 table set up in search.py)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'ticket', name='uq_trade_user_ticket'),  # Upserts from the ingestion API
+        db.Index('ix_trade_user_version', 'user_id', 'data_version'),  # Incremental refresh of the trade cache
+        db.Index('ft_trade_text', 'item', 'strategy', 'comments', mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     ticket = db.Column(db.String(20), nullable=False)
@@ -52,17 +81,21 @@ class Trade(db.Model):
     trade_type = db.Column(db.String(10), nullable=False)
     size = db.Column(db.Float, nullable=False)
     item = db.Column(db.String(20), nullable=False)
-    price = db.Column(DECIMAL(10, 2), nullable=False)
-    s_l = db.Column(DECIMAL(10, 2), nullable=False)
-    t_p = db.Column(DECIMAL(10, 2), nullable=False)
+    price = db.Column(DECIMAL(13, 5), nullable=False)
+    s_l = db.Column(DECIMAL(13, 5), nullable=False)
+    t_p = db.Column(DECIMAL(13, 5), nullable=False)
     close_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    close_price = db.Column(DECIMAL(10, 2), nullable=False)
+    close_price = db.Column(DECIMAL(13, 5), nullable=False)
     comm = db.Column(DECIMAL(10, 2), nullable=False)
     taxes = db.Column(DECIMAL(10, 2), nullable=False)
     swap = db.Column(DECIMAL(10, 2), nullable=False)
     profit = db.Column(DECIMAL(10, 2), nullable=False)
-    pips = db.Column(DECIMAL(10, 2), nullable=True)
+    pips = db.Column(DECIMAL(13, 5), nullable=True)
     duration = db.Column(db.Interval, nullable=True)
+    # Maximum adverse and favourable excursion in price, filled in from the bar store (bars.py)
+    mae = db.Column(db.Float, nullable=True)
+    mfe = db.Column(db.Float, nullable=True)
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # UserData.data_version of the last write
     comments = db.Column(db.Text, nullable=True)
     strategy = db.Column(db.String(255), nullable=True)
     screenshot1 = db.Column(db.String(255), nullable=True)
@@ -105,7 +138,191 @@ class Trade(db.Model):
         trade.calculate_pips()
         trade.calculate_duration()
         return trade
-    
+
+    def snapshot(self):
+        return TradeSnapshot(
+            trade_id=self.id,
+            user_id=self.user_id,
+            open_time=self.open_time,
+            size=float(self.size),
+            profit=Decimal(self.profit),
+            item=self.item,
+            strategy=self.strategy or '',
+            trade_type=self.trade_type
+        )
+
+class DailyPnl(db.Model):
+    __tablename__ = 'daily_pnl'
+    __table_args__ = (db.UniqueConstraint('user_id', 'date', name='uq_daily_pnl_user_date'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    trades = db.Column(db.Integer, nullable=False, default=0)
+    lots = db.Column(db.Float, nullable=False, default=0.0)
+    result = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
+    wins = db.Column(db.Integer, nullable=False, default=0)
+    losses = db.Column(db.Integer, nullable=False, default=0)
+    gross_profit = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
+    gross_loss = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
+
+# Finest-grain cell of the breakdown cube: one row per (user, instrument, strategy, direction, session, hour).
+class TradeBreakdown(db.Model):
+    __tablename__ = 'trade_breakdown'
+    __table_args__ = (db.UniqueConstraint('user_id', 'item', 'strategy', 'direction', 'session', 'hour', name='uq_trade_breakdown_cell'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    item = db.Column(db.String(20), nullable=False)
+    strategy = db.Column(db.String(255), nullable=False, default='')
+    direction = db.Column(db.String(10), nullable=False)
+    session = db.Column(db.String(20), nullable=False)
+    hour = db.Column(db.Integer, nullable=False)
+    trades = db.Column(db.Integer, nullable=False, default=0)
+    wins = db.Column(db.Integer, nullable=False, default=0)
+    losses = db.Column(db.Integer, nullable=False, default=0)
+    lots = db.Column(db.Float, nullable=False, default=0.0)
+    gross_profit = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
+    gross_loss = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
+
+# Typed copy of the UserData limits plus the running state the rule engine evaluates them against.
+class RuleState(db.Model):
+    __tablename__ = 'rule_state'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
+    # Parsed limits (None when the user has not set the rule)
+    max_daily_loss = db.Column(DECIMAL(18, 2), nullable=True)
+    daily_max_loss = db.Column(DECIMAL(18, 2), nullable=True)
+    max_loss = db.Column(DECIMAL(18, 2), nullable=True)
+    profit_target = db.Column(DECIMAL(18, 2), nullable=True)
+    consecutive_losers = db.Column(db.Integer, nullable=True)
+    trades_per_day = db.Column(db.Integer, nullable=True)
+    min_trading_days = db.Column(db.Integer, nullable=True)
+    # Running state, advanced one trade at a time in open_time order
+    day = db.Column(db.Date, nullable=True)
+    day_pnl = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
+    day_trades = db.Column(db.Integer, nullable=False, default=0)
+    losing_streak = db.Column(db.Integer, nullable=False, default=0)
+    total_pnl = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
+    equity_high = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
+    trading_days = db.Column(db.Integer, nullable=False, default=0)
+    last_trade_time = db.Column(db.DateTime, nullable=True)
+    # Equity high and losing streak as they stood before the first trade of day, to replay that day alone
+    day_start_high = db.Column(DECIMAL(18, 2), nullable=True)
+    day_start_streak = db.Column(db.Integer, nullable=True)
+
+# Cached Monte Carlo result of one user, keyed by the data version it was computed from and a hash of
+# the simulation parameters so that repeated requests are served without re-simulating.
+class MonteCarloRun(db.Model):
+    __tablename__ = 'monte_carlo_run'
+    __table_args__ = (db.UniqueConstraint('user_id', 'data_version', 'params_key', name='uq_monte_carlo_run_key'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    data_version = db.Column(db.Integer, nullable=False)
+    params_key = db.Column(db.String(40), nullable=False)
+    params = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')  # pending or done
+    result = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# Token an expert advisor authenticates with against the ingestion API. Only a SHA-256 hash of the
+# token is stored; the token itself is shown once when it is created.
+class ApiToken(db.Model):
+    __tablename__ = 'api_token'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    name = db.Column(db.String(100), nullable=False)
+    token_hash = db.Column(db.String(64), nullable=False, unique=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, nullable=True)
+
+# A batch of trades pushed through the ingestion API, queued for the ingest_trades task.
+class IngestBatch(db.Model):
+    __tablename__ = 'ingest_batch'
+    __table_args__ = (db.Index('ix_ingest_batch_status_user', 'status', 'user_id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # Validated trades as JSON
+    trade_count = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')  # pending, done or failed
+    result = db.Column(db.Text, nullable=True)
+    received_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime, nullable=True)
+
+# One year of a user's trades moved out of the live table into a compressed Arrow file by the archive
+# task. The row doubles as the summary of the partition, so totals don't need to open the file.
+class TradeArchivePartition(db.Model):
+    __tablename__ = 'trade_archive_partition'
+    __table_args__ = (db.UniqueConstraint('user_id', 'year', name='uq_trade_archive_partition_user_year'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    trades = db.Column(db.Integer, nullable=False, default=0)
+    profit = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
+    first_open_time = db.Column(db.DateTime, nullable=False)
+    last_open_time = db.Column(db.DateTime, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# Statistics of one user as computed by the nightly batch, for leaderboards and consistency checks.
+class UserStats(db.Model):
+    __tablename__ = 'user_stats'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
+    data_version = db.Column(db.Integer, nullable=False)  # UserData.data_version the stats were computed from
+    total_trades = db.Column(db.Integer, nullable=False, default=0)
+    winning_trades = db.Column(db.Integer, nullable=False, default=0)
+    win_rate = db.Column(db.Float, nullable=False, default=0.0)
+    net_profit = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
+    max_drawdown = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
+    lots = db.Column(db.Float, nullable=False, default=0.0)
+    average_rrr = db.Column(db.Float, nullable=False, default=0.0)
+    expectancy = db.Column(db.Float, nullable=False, default=0.0)
+    profit_factor = db.Column(db.Float, nullable=False, default=0.0)
+    sharpe_ratio = db.Column(db.Float, nullable=False, default=0.0)
+    repaired = db.Column(db.Boolean, nullable=False, default=False)  # Rollups or rule state were found out of step and rebuilt
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# One pass of the nightly batch. last_user_id is the checkpoint: every user up to it is done, so a
+# run interrupted by a crash resumes after it.
+class NightlyRun(db.Model):
+    __tablename__ = 'nightly_run'
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(10), nullable=False, default='running')  # running or done
+    last_user_id = db.Column(db.Integer, nullable=False, default=0)
+    users = db.Column(db.Integer, nullable=False, default=0)
+    repaired = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+# An economic calendar entry, loaded from a feed file by the load_economic_events task.
+class EconomicEvent(db.Model):
+    __tablename__ = 'economic_event'
+    __table_args__ = (db.UniqueConstraint('time', 'currency', 'title', name='uq_economic_event'),)
+    id = db.Column(db.Integer, primary_key=True)
+    time = db.Column(db.DateTime, nullable=False, index=True)  # UTC
+    currency = db.Column(db.String(10), nullable=False)
+    title = db.Column(db.String(255), nullable=False)
+    impact = db.Column(db.String(10), nullable=False)  # low, medium or high
+
+# A rendered weekly or monthly performance report. The artifacts are stored under REPORT_FOLDER by the
+# digest of the HTML, so a report whose content didn't change keeps its files.
+class PerformanceReport(db.Model):
+    __tablename__ = 'performance_report'
+    __table_args__ = (db.UniqueConstraint('user_id', 'period', 'start', name='uq_performance_report'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    period = db.Column(db.String(10), nullable=False)  # week or month
+    start = db.Column(db.Date, nullable=False)
+    end = db.Column(db.Date, nullable=False)  # Last day of the period
+    data_version = db.Column(db.Integer, nullable=False)  # UserData.data_version the report was rendered from
+    digest = db.Column(db.String(64), nullable=True)  # sha256 of the HTML, None when there were no trades
+    pdf = db.Column(db.Boolean, nullable=False, default=False)
+    trades = db.Column(db.Integer, nullable=False, default=0)
+    net_profit = db.Column(DECIMAL(18, 2), nullable=False, default=0.0)
+    generated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # Path of an artifact under the static folder, for url_for('static', filename=...)
+    def artifact(self, extension):
+        return f'reports/{self.digest[:2]}/{self.digest}.{extension}'
+
 class ChecklistCategory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -120,6 +337,12 @@ class ChecklistItem(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
 class TradingPlan(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'date', name='uq_trading_plan_user_date'),
+        db.Index('ft_trading_plan_text', 'market_conditions', 'goals', 'risk_management', 'entry_exit_criteria', 'trade_setup',
+                 'review_notes', 'news_events', 'premarket_routine', 'timeframe', 'market_type', 'entries', 'stop_loss',
+                 'take_profit', mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     date = db.Column(db.Date, nullable=False, default=datetime.utcnow)
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import secrets
+from datetime import datetime, timedelta
+import numpy as np
+from billiard import Pool
+from sqlalchemy.exc import IntegrityError
+from tradepilot import app, db
+from tradepilot.archive import trade_rows
+from tradepilot.db_routing import use_replica
+from tradepilot.models import MonteCarloRun, UserData
+from tradepilot.rules import get_rule_state
+
+SIMULATION_METHODS = ('bootstrap', 'shuffle')
+DRAWDOWN_PERCENTILES = (50, 75, 90, 95, 99)
+TIME_PERCENTILES = (10, 25, 50, 75, 90)
+
+# A pending run older than this is assumed lost (worker restart) and is queued again.
+STALE_RUN_AFTER = timedelta(minutes=10)
+
+# Peak memory a chunk needs per path and trade: two float64 matrices (the sampled indices and the
+# samples, then the equity and drawdown) plus a boolean mask, rounded up.
+CHUNK_BYTES_PER_STEP = 3 * 8
+
+def _first_true(mask):
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), -1)
+
+# Simulate one chunk of equity paths. Each chunk draws from its own child of the run's seed, so the
+# combined result only depends on the seed and the chunk layout, not on which process ran what.
+# Returns the max drawdown of every path and the trade index at which it first breached max_loss
+# (trailing, from the running equity high) and first reached profit_target, or -1 if never.
+def simulate_chunk(profits, paths, horizon, max_loss, profit_target, method, seed, chunk_index):
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(chunk_index,)))
+    profits = np.asarray(profits, dtype=np.float64)
+    if method == 'shuffle':
+        samples = rng.permuted(np.broadcast_to(profits, (paths, profits.size)), axis=1)
+    else:
+        samples = profits[rng.integers(0, profits.size, size=(paths, horizon))]
+
+    # Worked in place, so a chunk holds only two paths x horizon float64 matrices at a time
+    equity = np.cumsum(samples, axis=1, out=samples)
+    drawdown = np.maximum.accumulate(equity, axis=1)
+    np.maximum(drawdown, 0, out=drawdown)
+    drawdown -= equity
+    max_drawdown = drawdown.max(axis=1).astype(np.float32)
+    breach_at = _first_true(drawdown >= max_loss) if max_loss else np.full(paths, -1)
+    target_at = _first_true(equity >= profit_target) if profit_target else np.full(paths, -1)
+    return max_drawdown, breach_at.astype(np.int32), target_at.astype(np.int32)
+
+def _simulate_chunk_args(args):
+    return simulate_chunk(*args)
+
+def _percentiles(values, percentiles):
+    if not values.size:
+        return {}
+    return {str(p): round(float(v), 2) for p, v in zip(percentiles, np.percentile(values, percentiles))}
+
+# Merge the chunk outputs into drawdown percentiles, breach/target probabilities and the
+# time-to-target distribution (in trades).
+def summarize(chunks, max_loss, profit_target):
+    max_drawdown = np.concatenate([chunk[0] for chunk in chunks])
+    breach_at = np.concatenate([chunk[1] for chunk in chunks])
+    target_at = np.concatenate([chunk[2] for chunk in chunks])
+
+    breach_first = (breach_at >= 0) & ((target_at < 0) | (breach_at < target_at))
+    target_first = (target_at >= 0) & ((breach_at < 0) | (target_at < breach_at))
+    times = target_at[target_first] + 1
+    counts, edges = np.histogram(times, bins=min(20, max(int(times.size), 1))) if times.size else (np.array([]), np.array([]))
+    return {
+        'drawdown_percentiles': _percentiles(max_drawdown, DRAWDOWN_PERCENTILES),
+        'probability_breach_before_target': float(breach_first.mean()) if max_loss else None,
+        'probability_target_before_breach': float(target_first.mean()) if profit_target else None,
+        'probability_neither': float((~breach_first & ~target_first).mean()) if max_loss or profit_target else None,
+        'time_to_target_percentiles': _percentiles(times, TIME_PERCENTILES),
+        'time_to_target_histogram': {'edges': [round(float(edge), 1) for edge in edges], 'counts': [int(count) for count in counts]},
+    }
+
+# Paths per chunk that keep a chunk of the given horizon within chunk_bytes.
+def chunk_paths_for(horizon, chunk_bytes):
+    return max(1, chunk_bytes // (horizon * CHUNK_BYTES_PER_STEP))
+
+# Run the whole simulation, fanning the chunks out over a billiard process pool. billiard (Celery's
+# multiprocessing fork) is used because it may be started from inside a daemonic prefork worker.
+# Chunks are sized from a memory budget, so long shuffle horizons get fewer paths per chunk.
+def run_simulation(profits, paths, horizon, max_loss, profit_target, method, seed, workers=1, chunk_bytes=256 * 1024 * 1024):
+    chunk_paths = chunk_paths_for(horizon, chunk_bytes)
+    chunk_sizes = [min(chunk_paths, paths - start) for start in range(0, paths, chunk_paths)]
+    args = [(profits, size, horizon, max_loss, profit_target, method, seed, index) for index, size in enumerate(chunk_sizes)]
+    if workers > 1 and len(args) > 1:
+        with Pool(processes=min(workers, len(args))) as pool:
+            chunks = pool.map(_simulate_chunk_args, args)
+    else:
+        chunks = [simulate_chunk(*chunk_args) for chunk_args in args]
+    return summarize(chunks, max_loss, profit_target)
+
+# Validate request arguments into the simulation parameters that make up the cache key.
+def parse_simulation_args(args):
+    try:
+        paths = int(args.get('paths', 100000))
+        horizon = int(args['horizon']) if args.get('horizon') else None
+        seed = int(args['seed']) if args.get('seed') not in (None, '') else None
+    except ValueError:
+        raise ValueError('paths, horizon and seed must be whole numbers')
+    method = args.get('method', 'bootstrap')
+    if not 1000 <= paths <= 1000000:
+        raise ValueError('paths must be between 1,000 and 1,000,000')
+    if horizon is not None and not 1 <= horizon <= 10000:
+        raise ValueError('horizon must be between 1 and 10,000 trades')
+    if method not in SIMULATION_METHODS:
+        raise ValueError('method must be one of ' + ', '.join(SIMULATION_METHODS))
+    if seed is not None and seed < 0:
+        raise ValueError('seed must not be negative')
+    return {'paths': paths, 'horizon': horizon, 'method': method, 'seed': seed}
+
+# The ruin and target thresholds of the user's current rules. They are part of a run's parameters,
+# so changing the limits in the account settings gets a fresh run instead of the cached one.
+def _rule_limits(user_id):
+    state = get_rule_state(user_id)
+    return {'max_loss': float(state.max_loss) if state.max_loss else None,
+            'profit_target': float(state.profit_target) if state.profit_target else None}
+
+def _params_key(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+# Find the cached run for these parameters and the user's current limits at their current data
+# version, creating a pending one if there is none. Returns (run, needs_queueing).
+def get_or_create_run(user_id, params):
+    data_version = UserData.get_data_version(user_id)
+    params = dict(params, **_rule_limits(user_id))
+    key = _params_key(params)
+    run = MonteCarloRun.query.filter_by(user_id=user_id, data_version=data_version, params_key=key).first()
+    if run:
+        if run.status == 'pending' and run.created_at < datetime.utcnow() - STALE_RUN_AFTER:
+            run.created_at = datetime.utcnow()
+            db.session.commit()
+            return run, True
+        return run, False
+    run = MonteCarloRun(user_id=user_id, data_version=data_version, params_key=key, params=json.dumps(params), status='pending')
+    db.session.add(run)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request queued the same run in the meantime
+        db.session.rollback()
+        return MonteCarloRun.query.filter_by(user_id=user_id, data_version=data_version, params_key=key).first(), False
+    return run, True
+
+# Execute a queued run and store its result on the row.
+def execute_run(run_id):
+    run = MonteCarloRun.query.get(run_id)
+    if not run or run.status == 'done':
+        return
+    params = json.loads(run.params)
+    # The replica only serves the trades when it has the data version the run is stored under
+    with use_replica():
+        version = UserData.get_data_version(run.user_id)
+        profits = [float(row.profit) for row in trade_rows(run.user_id, ('profit',))]
+    if version != run.data_version:
+        profits = [float(row.profit) for row in trade_rows(run.user_id, ('profit',))]
+    limits = params if 'max_loss' in params else _rule_limits(run.user_id)
+    max_loss, profit_target = limits['max_loss'], limits['profit_target']
+
+    if not profits:
+        result = {'error': 'No trades to simulate yet.'}
+    else:
+        seed = params['seed'] if params['seed'] is not None else secrets.randbits(64)
+        horizon = len(profits) if params['method'] == 'shuffle' else params['horizon'] or len(profits)
+        result = run_simulation(profits, params['paths'], horizon, max_loss, profit_target, params['method'], seed,
+                                workers=app.config['MONTE_CARLO_WORKERS'], chunk_bytes=app.config['MONTE_CARLO_CHUNK_MB'] * 1024 * 1024)
+        result.update({'seed': seed, 'horizon': horizon, 'trades': len(profits), 'max_loss': max_loss, 'profit_target': profit_target})
+    result.update({'paths': params['paths'], 'method': params['method'], 'data_version': run.data_version})
+    run.result = json.dumps(result)
+    run.status = 'done'
+    db.session.commit()
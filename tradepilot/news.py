@@ -0,0 +1,173 @@
+import csv
+import json
+import logging
+import re
+from datetime import timedelta
+import numpy as np
+from sqlalchemy import insert
+from tradepilot import app, db
+from tradepilot.ingest import parse_trade_time
+from tradepilot.models import EconomicEvent
+from tradepilot.trade_cache import cached_trade_rows
+
+IMPACTS = ('low', 'medium', 'high')
+IMPACT_ALIASES = {'l': 'low', '1': 'low', 'm': 'medium', 'med': 'medium', '2': 'medium', 'h': 'high', '3': 'high'}
+CURRENCIES = ('USD', 'EUR', 'GBP', 'JPY', 'CHF', 'CAD', 'AUD', 'NZD', 'CNY', 'CNH', 'HKD', 'SGD', 'SEK', 'NOK', 'MXN', 'ZAR')
+# Currency an index, metal or energy contract moves with, by prefix of its symbol. Anything else that
+# doesn't name a currency is taken to be priced in dollars.
+SYMBOL_CURRENCIES = (('GER', 'EUR'), ('DE', 'EUR'), ('DAX', 'EUR'), ('EU', 'EUR'), ('FRA', 'EUR'), ('ESP', 'EUR'),
+                     ('UK', 'GBP'), ('FTSE', 'GBP'), ('JP', 'JPY'), ('NIK', 'JPY'), ('AUS', 'AUD'), ('HK', 'HKD'),
+                     ('CHINA', 'CNY'), ('SWI', 'CHF'))
+# Energy and metal contracts are priced in dollars whatever their symbol starts with (UKOIL is Brent).
+DOLLAR_COMMODITIES = ('OIL', 'BRENT', 'WTI', 'CRUDE', 'NGAS', 'NATGAS', 'GOLD', 'SILVER', 'COPPER', 'PLATINUM', 'PALLADIUM',
+                      'XAU', 'XAG', 'XPT', 'XPD')
+
+# Currencies whose news moves an instrument: the ones in a pair's name (EURUSD, XAUUSD), the dollar for
+# energy and metals, else by symbol prefix.
+def instrument_currencies(item):
+    symbol = re.sub(r'[^A-Z0-9]', '', (item or '').upper())
+    found = tuple(currency for currency in CURRENCIES if currency in symbol)
+    if found:
+        return found
+    if any(name in symbol for name in DOLLAR_COMMODITIES):
+        return ('USD',)
+    for prefix, currency in SYMBOL_CURRENCIES:
+        if symbol.startswith(prefix):
+            return (currency,)
+    return ('USD',)
+
+def _read_feed(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.json'):
+            data = json.load(f)
+            return data.get('events', []) if isinstance(data, dict) else data
+        return list(csv.DictReader(f))
+
+# Normalize one feed entry into EconomicEvent columns, raising ValueError. Accepts a "time" (or
+# "date" and "time") in any format parse_trade_time understands, plus currency, title (or event)
+# and impact. Times with a UTC offset are converted to UTC; times without one are taken to be UTC.
+def parse_event(item):
+    lowered = {str(key).strip().lower(): value for key, value in item.items()}
+    moment = lowered.get('time') or lowered.get('datetime') or lowered.get('date')
+    if lowered.get('date') and lowered.get('time') and len(str(lowered['time'])) <= 8:
+        moment = f"{lowered['date']} {lowered['time']}"  # Separate date and time columns
+    if not moment:
+        raise ValueError('missing time')
+    try:
+        moment = parse_trade_time(moment)
+    except (ValueError, OverflowError, OSError):
+        raise ValueError(f'bad time {moment!r}')
+    currency = str(lowered.get('currency') or '').strip().upper()
+    title = str(lowered.get('title') or lowered.get('event') or '').strip()
+    impact = str(lowered.get('impact') or '').strip().lower()
+    impact = IMPACT_ALIASES.get(impact, impact)
+    if not currency or not title:
+        raise ValueError('missing currency or title')
+    if impact not in IMPACTS:
+        raise ValueError(f'unknown impact {impact!r}')
+    return {'time': moment, 'currency': currency[:10], 'title': title[:255], 'impact': impact}
+
+# Load a CSV or JSON calendar feed into economic_event. Events already stored (same time, currency
+# and title) are skipped, so the same feed can be loaded every day.
+def load_events(path):
+    events, skipped = {}, 0
+    for item in _read_feed(path):
+        try:
+            event = parse_event(item)
+        except ValueError as e:
+            logging.debug('Skipping calendar entry %r: %s', item, e)
+            skipped += 1
+            continue
+        events[(event['time'], event['currency'], event['title'])] = event
+    if events:
+        times = [key[0] for key in events]
+        stored = db.session.query(EconomicEvent.time, EconomicEvent.currency, EconomicEvent.title) \
+            .filter(EconomicEvent.time.between(min(times), max(times)))
+        for key in stored:
+            events.pop(tuple(key), None)
+    if events:
+        db.session.execute(insert(EconomicEvent), list(events.values()))
+    db.session.commit()
+    return {'loaded': len(events), 'skipped': skipped}
+
+# Windows of time around events, sorted so that a batch of intervals can be joined against them with
+# two binary searches each. Every window has the same width, so sorting by start also sorts the
+# ends, and the windows overlapping [open, close] are the contiguous run from the first one ending
+# at or after open to the last one starting at or before close.
+class EventIndex:
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, times, window):
+        times = np.sort(np.asarray(times, dtype='datetime64[s]'))
+        self.starts = times - window
+        self.ends = times + window
+
+    # Number of windows each [opens[i], closes[i]] overlaps, in O(n log m).
+    def count_overlaps(self, opens, closes):
+        first = np.searchsorted(self.ends, opens, side='left')
+        stop = np.searchsorted(self.starts, closes, side='right')
+        return np.maximum(stop - first, 0)
+
+def _bucket(profits, sizes):
+    wins = int((profits > 0).sum())
+    gross_profit = float(profits[profits > 0].sum())
+    gross_loss = float(-profits[profits <= 0].sum())
+    trades = len(profits)
+    net = gross_profit - gross_loss
+    return {
+        'trades': trades,
+        'wins': wins,
+        'losses': trades - wins,
+        'lots': float(sizes.sum()),
+        'net_profit': net,
+        'win_rate': wins / trades * 100 if trades else 0,
+        'expectancy': net / trades if trades else 0,
+        'profit_factor': gross_profit / gross_loss if gross_loss > 0 else 0,
+    }
+
+# P&L of a user's trades held through news of at least the given impact (an event of one of the
+# instrument's currencies within NEWS_WINDOW_MINUTES of the time the trade was open) versus the rest,
+# overall and per instrument. The whole journal is joined against the events in one pass per currency.
+def news_breakdown(user_id, impact='high'):
+    rows = cached_trade_rows(user_id, ('close_time', 'profit', 'size', 'item'))
+    window = np.timedelta64(app.config['NEWS_WINDOW_MINUTES'] * 60, 's')
+    opens = np.array([row.open_time for row in rows], dtype='datetime64[s]')
+    closes = np.array([row.close_time or row.open_time for row in rows], dtype='datetime64[s]')
+    profits = np.array([float(row.profit) for row in rows])
+    sizes = np.array([float(row.size) for row in rows])
+    positions_by_item = {}
+    for index, row in enumerate(rows):
+        positions_by_item.setdefault(row.item, []).append(index)
+
+    counts = np.zeros(len(rows), dtype=np.int64)
+    events = 0
+    if rows:
+        margin = timedelta(minutes=app.config['NEWS_WINDOW_MINUTES'])
+        query = db.session.query(EconomicEvent.currency, EconomicEvent.time) \
+            .filter(EconomicEvent.impact.in_(IMPACTS[IMPACTS.index(impact):]),
+                    EconomicEvent.time.between(min(row.open_time for row in rows) - margin,
+                                               max(row.close_time or row.open_time for row in rows) + margin))
+        times = {}
+        for currency, moment in query:
+            times.setdefault(currency, []).append(moment)
+            events += 1
+        indexes = {currency: EventIndex(moments, window) for currency, moments in times.items()}
+
+        by_currencies = {}
+        for item, positions in positions_by_item.items():
+            by_currencies.setdefault(instrument_currencies(item), []).extend(positions)
+        for currencies, positions in by_currencies.items():
+            positions = np.array(positions)
+            for currency in currencies:
+                if currency in indexes:
+                    counts[positions] += indexes[currency].count_overlaps(opens[positions], closes[positions])
+
+    held = counts > 0
+    by_item = []
+    for item in sorted(positions_by_item, key=lambda item: item or ''):
+        positions = np.array(positions_by_item[item])
+        item_held = held[positions]
+        by_item.append({'item': item, 'news': _bucket(profits[positions][item_held], sizes[positions][item_held]),
+                        'other': _bucket(profits[positions][~item_held], sizes[positions][~item_held])})
+    return {'impact': impact, 'events': events, 'news': _bucket(profits[held], sizes[held]),
+            'other': _bucket(profits[~held], sizes[~held]), 'by_item': by_item}
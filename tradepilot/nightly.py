@@ -0,0 +1,146 @@
+import logging
+from datetime import datetime
+from decimal import Decimal
+from itertools import groupby
+from billiard import Pool
+from tradepilot import app, db
+from tradepilot.archive import trade_row_type, trade_rows
+from tradepilot.db_routing import use_replica
+from tradepilot.models import NightlyRun, RuleState, Trade, TradeArchivePartition, TradeSnapshot, User, UserData, UserStats
+from tradepilot.rollups import replace_rollups, rollup_mismatches
+from tradepilot.rules import replay_rule_state
+from tradepilot.stats import compute_stats
+
+# Trade columns the batch needs for the statistics, the rule state and the rollups.
+BATCH_COLUMNS = ('profit', 'size', 'price', 's_l', 't_p', 'item', 'strategy', 'trade_type')
+RULE_STATE_FIELDS = ('day', 'day_pnl', 'day_trades', 'losing_streak', 'total_pnl', 'equity_high', 'trading_days', 'last_trade_time',
+                     'day_start_high', 'day_start_streak')
+STATS_FIELDS = ('total_trades', 'winning_trades', 'win_rate', 'net_profit', 'max_drawdown', 'lots', 'average_rrr',
+                'expectancy', 'profit_factor', 'sharpe_ratio')
+
+# Every trade of the users in one chunk, read with a single query ordered by user, open_time and id and
+# split per user. Users with archived partitions have their history read through trade_rows instead.
+def _chunk_trades(user_ids):
+    row_type = trade_row_type(('open_time', 'id') + BATCH_COLUMNS)
+    query = db.session.query(Trade.user_id, Trade.open_time, Trade.id, *(getattr(Trade, column) for column in BATCH_COLUMNS)) \
+        .filter(Trade.user_id.in_(user_ids)).order_by(Trade.user_id, Trade.open_time, Trade.id)
+    trades = {user_id: [] for user_id in user_ids}
+    for user_id, rows in groupby(query, key=lambda row: row[0]):
+        trades[user_id] = [row_type(*row[1:]) for row in rows]
+    archived = db.session.query(TradeArchivePartition.user_id).filter(TradeArchivePartition.user_id.in_(user_ids)).distinct()
+    for (user_id,) in archived:
+        trades[user_id] = trade_rows(user_id, BATCH_COLUMNS)
+    return trades
+
+def _snapshot(user_id, row):
+    return TradeSnapshot(row.id, user_id, row.open_time, row.size, Decimal(row.profit), row.item, row.strategy or '', row.trade_type)
+
+def _rule_state_values(state):
+    return tuple(getattr(state, field) for field in RULE_STATE_FIELDS) if state else None
+
+# Read the data versions of a chunk of users, then their trades, rollup mismatches and rule states.
+def _read_chunk(user_ids):
+    versions = dict(db.session.query(UserData.user_id, UserData.data_version).filter(UserData.user_id.in_(user_ids)))
+    trades = _chunk_trades(user_ids)
+    snapshots = {user_id: [_snapshot(user_id, row) for row in rows] for user_id, rows in trades.items()}
+    mismatched = rollup_mismatches(snapshots)
+    # Columns rather than entities, so the replica's rows never land in the session's identity map
+    query = db.session.query(RuleState.user_id, *(getattr(RuleState, field) for field in RULE_STATE_FIELDS)).filter(RuleState.user_id.in_(user_ids))
+    states = {state.user_id: _rule_state_values(state) for state in query}
+    return versions, trades, snapshots, mismatched, states
+
+# Recompute the statistics, rule state and rollups of one chunk of users and commit them. Rollups and
+# rule states that disagree with the trades are rebuilt and the user's data version is bumped.
+def process_chunk(user_ids):
+    with use_replica():
+        replica_versions, trades, snapshots, mismatched, states = _read_chunk(user_ids)
+    # Locking the chunk's account rows holds back these users' trade writes (which bump data_version)
+    # until the chunk is committed. Users the replica had at the locked version keep its reads; the
+    # others are read again from the primary, so the trades, rollups and rule states agree.
+    versions = dict(db.session.query(UserData.user_id, UserData.data_version).filter(UserData.user_id.in_(user_ids)).with_for_update())
+    behind = [user_id for user_id in versions if replica_versions.get(user_id) != versions[user_id]]
+    if behind:
+        _, behind_trades, behind_snapshots, behind_mismatched, behind_states = _read_chunk(behind)
+        trades.update(behind_trades)
+        snapshots.update(behind_snapshots)
+        mismatched = (mismatched - set(behind)) | behind_mismatched
+        states = {user_id: values for user_id, values in states.items() if user_id not in behind}
+        states.update(behind_states)
+    stats = {row.user_id: row for row in UserStats.query.filter(UserStats.user_id.in_(user_ids))}
+
+    repaired = 0
+    for user_id in user_ids:
+        if user_id not in versions:
+            continue
+        before = states.get(user_id)
+        state = replay_rule_state(user_id, trades[user_id])
+        user_repaired = user_id in mismatched or (before is not None and _rule_state_values(state) != before)
+        if user_id in mismatched:
+            replace_rollups(user_id, snapshots[user_id])
+        if user_repaired:
+            versions[user_id] = UserData.bump_data_version(user_id)
+            repaired += 1
+            logging.warning('Nightly batch rebuilt the %s of user %s', 'rollups' if user_id in mismatched else 'rule state', user_id)
+
+        values = compute_stats(trades[user_id])
+        row = stats.get(user_id)
+        if row is None:
+            row = UserStats(user_id=user_id)
+            db.session.add(row)
+        for field in STATS_FIELDS:
+            setattr(row, field, values[field])
+        row.data_version = versions[user_id]
+        row.repaired = user_repaired
+        row.computed_at = datetime.utcnow()
+    db.session.commit()
+    return len(user_ids), repaired
+
+def _process_chunk_in_context(user_ids):
+    with app.app_context():
+        return process_chunk(user_ids)
+
+# Pool workers inherit the parent's connection pool through fork; drop it without closing the
+# parent's connections so each worker opens its own.
+def _init_worker():
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+def _next_user_ids(after, limit):
+    return [user_id for (user_id,) in db.session.query(User.id).filter(User.id > after).order_by(User.id).limit(limit)]
+
+# Stream user ids a page at a time and map chunks of each page over process, advancing the checkpoint
+# as chunks come back. They come back in order, so the checkpoint never moves past an unfinished user.
+def _process_users(run, process, mapper, chunk_size, page_size):
+    while True:
+        user_ids = _next_user_ids(run.last_user_id, page_size)
+        if not user_ids:
+            return
+        chunks = [user_ids[start:start + chunk_size] for start in range(0, len(user_ids), chunk_size)]
+        for chunk, (users, repaired) in zip(chunks, mapper(process, chunks)):
+            run.last_user_id = chunk[-1]
+            run.users += users
+            run.repaired += repaired
+            db.session.commit()
+
+# Recompute every user's statistics, rule state and rollups, spreading chunks of users over a process
+# pool. An interrupted run is picked up after its checkpoint by the next call.
+def run_nightly(workers=None, chunk_size=None):
+    workers = workers or app.config['NIGHTLY_WORKERS']
+    chunk_size = chunk_size or app.config['NIGHTLY_CHUNK_USERS']
+    run = NightlyRun.query.filter_by(status='running').order_by(NightlyRun.id.desc()).first()
+    if run is None:
+        run = NightlyRun(status='running', last_user_id=0, users=0, repaired=0)
+        db.session.add(run)
+    # Commit before forking so the workers don't inherit an open transaction
+    db.session.commit()
+
+    if workers > 1:
+        with Pool(processes=workers, initializer=_init_worker) as pool:
+            _process_users(run, _process_chunk_in_context, pool.imap, chunk_size, chunk_size * workers * 2)
+    else:
+        _process_users(run, process_chunk, map, chunk_size, chunk_size)
+    run.status = 'done'
+    run.finished_at = datetime.utcnow()
+    db.session.commit()
+    return run
@@ -0,0 +1,173 @@
+import hashlib
+import logging
+import os
+from datetime import datetime, timedelta
+from decimal import Decimal
+from flask import render_template
+from sqlalchemy.exc import IntegrityError
+from tradepilot import app, db
+from tradepilot.archive import trade_rows
+from tradepilot.db_routing import use_replica
+from tradepilot.models import PerformanceReport, TradeSnapshot, User, UserData
+from tradepilot.rollups import breakdown_of, get_daily_pnl
+from tradepilot.stats import compute_stats, format_stats
+
+try:
+    from weasyprint import HTML, default_url_fetcher
+except ImportError:
+    HTML = None
+
+REPORT_PERIODS = ('week', 'month')
+REPORT_COLUMNS = ('ticket', 'close_time', 'trade_type', 'size', 'item', 'price', 's_l', 't_p', 'profit', 'strategy',
+                  'screenshot1', 'screenshot2', 'screenshot3')
+REPORT_DIMENSIONS = ('item', 'strategy', 'direction', 'session')
+
+# First and last day of the week (Monday first) or month containing day.
+def period_bounds(period, day):
+    if period == 'week':
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=6)
+    start = day.replace(day=1)
+    next_start = (start + timedelta(days=32)).replace(day=1)
+    return start, next_start - timedelta(days=1)
+
+# The periods kept up to date: the current and the previous week and month, so that trades logged
+# late still make it into the report of the period they were opened in.
+def report_periods(today=None):
+    today = today or datetime.utcnow().date()
+    periods = []
+    for period in REPORT_PERIODS:
+        start, end = period_bounds(period, today)
+        periods.append((period, *period_bounds(period, start - timedelta(days=1))))
+        periods.append((period, start, end))
+    return periods
+
+def _artifact_path(digest, extension):
+    return os.path.join(app.config['REPORT_FOLDER'], digest[:2], f'{digest}.{extension}')
+
+# Write content under its digest unless it is already there; returns the digest.
+def _store(content):
+    digest = hashlib.sha256(content).hexdigest()
+    path = _artifact_path(digest, 'html')
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+    return digest
+
+# Images and stylesheets under /static are read from disk rather than over HTTP.
+def _fetch_url(url):
+    prefix = 'file:///static/'
+    if url.startswith(prefix):
+        url = 'file://' + os.path.join(os.path.abspath(app.static_folder), url[len(prefix):])
+    return default_url_fetcher(url)
+
+def _render_pdf(html, digest):
+    path = _artifact_path(digest, 'pdf')
+    if not os.path.exists(path):
+        HTML(string=html, base_url='file:///', url_fetcher=_fetch_url).write_pdf(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+# Drop the artifacts of a digest no report points at any more.
+def _release(digest):
+    if digest is None or PerformanceReport.query.filter_by(digest=digest).count():
+        return
+    for extension in ('html', 'pdf'):
+        path = _artifact_path(digest, extension)
+        if os.path.exists(path):
+            os.remove(path)
+
+def _snapshot(user_id, row):
+    return TradeSnapshot(row.id, user_id, row.open_time, row.size, Decimal(row.profit), row.item, row.strategy or '', row.trade_type)
+
+# Everything report.html shows for one period, or None when no trade was opened in it.
+def build_report(user, period, start, end):
+    rows = trade_rows(user.id, REPORT_COLUMNS, datetime.combine(start, datetime.min.time()),
+                      datetime.combine(end, datetime.max.time()))
+    if not rows:
+        return None
+    snapshots = [_snapshot(user.id, row) for row in rows]
+    # Account equity and balance are left out: they move with every trade, and the report of a
+    # period should only change when that period's trades do
+    return dict(
+        format_stats(compute_stats(rows)),
+        user=user,
+        period=period,
+        start=start,
+        end=end,
+        daily_summaries=get_daily_pnl(user.id, start, end),
+        breakdowns=[(dimension, breakdown_of(snapshots, [dimension])) for dimension in REPORT_DIMENSIONS],
+        best_trade=max(rows, key=lambda row: row.profit),
+        worst_trade=min(rows, key=lambda row: row.profit),
+    )
+
+# Render the user's reports of the current and previous periods whose data version is behind the user's.
+# Unchanged content keeps its artifacts; a new digest replaces the report's files.
+def render_user_reports(user_id, today=None):
+    # Read on the replica before the trades, so a write landing during rendering (or not yet replicated)
+    # leaves the report stale for the next run
+    with use_replica():
+        user = db.session.get(User, user_id)
+        if user is None:
+            return 0
+        version = UserData.get_data_version(user_id)
+    rendered = 0
+    for period, start, end in report_periods(today):
+        report = PerformanceReport.query.filter_by(user_id=user_id, period=period, start=start).first()
+        # Data versions only grow, so a lagging replica never replaces a newer report
+        if report is not None and report.data_version >= version:
+            continue
+        with use_replica():
+            context = build_report(user, period, start, end)
+        if report is None:
+            report = PerformanceReport(user_id=user_id, period=period, start=start, end=end)
+            db.session.add(report)
+        previous = report.digest
+        if context is None:
+            report.digest, report.pdf, report.trades, report.net_profit = None, False, 0, 0
+        else:
+            # A request context lets the shared templates build their static URLs outside a request
+            with app.test_request_context():
+                html = render_template('report.html', **context)
+            report.digest = _store(html.encode('utf-8'))
+            report.trades = context['total_trades']
+            report.net_profit = context['net_profit']
+            if HTML is not None:
+                try:
+                    _render_pdf(html, report.digest)
+                    report.pdf = True
+                except Exception:
+                    logging.exception('Could not render the PDF of report %s', report.digest)
+                    report.pdf = False
+            rendered += 1
+        report.data_version = version
+        report.generated_at = datetime.utcnow()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker created this report first; it will have rendered the same data
+            db.session.rollback()
+            continue
+        if previous != report.digest:
+            _release(previous)
+    return rendered
+
+# Users with a current or previous period report that is missing or older than their data version.
+# One query for the versions and one for the reports of those periods.
+def stale_report_users(today=None):
+    periods = report_periods(today)
+    versions = dict(db.session.query(UserData.user_id, UserData.data_version))
+    rendered = {}
+    query = db.session.query(PerformanceReport.user_id, PerformanceReport.period, PerformanceReport.start, PerformanceReport.data_version) \
+        .filter(PerformanceReport.start >= min(start for period, start, end in periods))
+    for user_id, period, start, version in query:
+        rendered[(user_id, period, start)] = version
+    return [user_id for user_id, version in sorted(versions.items())
+            if any(rendered.get((user_id, period, start)) != version for period, start, end in periods)]
+
+def get_reports(user_id, period=None):
+    query = PerformanceReport.query.filter(PerformanceReport.user_id == user_id, PerformanceReport.digest.isnot(None))
+    if period:
+        query = query.filter_by(period=period)
+    return query.order_by(PerformanceReport.start.desc(), PerformanceReport.period).all()
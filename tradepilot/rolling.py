@@ -0,0 +1,248 @@
+import threading
+from collections import OrderedDict
+from sqlalchemy import event
+from tradepilot import app, db
+from tradepilot.archive import get_partitions
+from tradepilot.models import DailyPnl, Trade, UserData
+from tradepilot.trade_cache import cached_trade_rows
+
+# Per-trade risk-free return used for the Sharpe ratio, matching calculate_sharpe_ratio.
+RISK_FREE_RATE = 0.02
+
+# Fixed-size ring buffer of (trades, wins, pnl, gross_profit, gross_loss) entries with running sums.
+# Entries are keyed by a sortable key (a trade's (open_time, id) or a day's date) so that an entry
+# inside the window can be replaced in O(1) when the trade or day it describes changes.
+class RollingWindow:
+    __slots__ = ('size', 'keys', 'entries', 'slots', 'head', 'count',
+                 'trades', 'wins', 'pnl', 'pnl_sq', 'gross_profit', 'gross_loss')
+
+    def __init__(self, size):
+        self.size = size
+        self.keys = [None] * size
+        self.entries = [None] * size
+        self.slots = {}
+        self.head = 0
+        self.count = 0
+        self.trades = 0
+        self.wins = 0
+        self.pnl = 0.0
+        self.pnl_sq = 0.0
+        self.gross_profit = 0.0
+        self.gross_loss = 0.0
+
+    def _accumulate(self, entry, sign):
+        trades, wins, pnl, gross_profit, gross_loss = entry
+        self.trades += sign * trades
+        self.wins += sign * wins
+        self.pnl += sign * pnl
+        self.pnl_sq += sign * pnl * pnl
+        self.gross_profit += sign * gross_profit
+        self.gross_loss += sign * gross_loss
+
+    # Append the newest entry, evicting the oldest one when the window is full.
+    def push(self, key, entry):
+        if self.count == self.size:
+            self._accumulate(self.entries[self.head], -1)
+            del self.slots[self.keys[self.head]]
+        else:
+            self.count += 1
+        self.keys[self.head] = key
+        self.entries[self.head] = entry
+        self.slots[key] = self.head
+        self._accumulate(entry, 1)
+        self.head = (self.head + 1) % self.size
+
+    # Swap the entry stored under key for a new one. Returns False when key is not in the window.
+    def replace(self, key, entry):
+        slot = self.slots.get(key)
+        if slot is None:
+            return False
+        self._accumulate(self.entries[slot], -1)
+        self.entries[slot] = entry
+        self._accumulate(entry, 1)
+        return True
+
+    def get(self, key):
+        slot = self.slots.get(key)
+        return self.entries[slot] if slot is not None else None
+
+    def is_full(self):
+        return self.count == self.size
+
+    def oldest_key(self):
+        if not self.count:
+            return None
+        return self.keys[self.head] if self.is_full() else self.keys[0]
+
+    def newest_key(self):
+        return self.keys[(self.head - 1) % self.size] if self.count else None
+
+    def metrics(self):
+        mean = self.pnl / self.count if self.count else 0
+        variance = max(self.pnl_sq / self.count - mean ** 2, 0) if self.count else 0
+        std_dev = variance ** 0.5
+        return {
+            'samples': self.count,
+            'trades': self.trades,
+            'win_rate': self.wins / self.trades * 100 if self.trades else 0,
+            'expectancy': self.pnl / self.trades if self.trades else 0,
+            'profit_factor': self.gross_profit / self.gross_loss if self.gross_loss > 0 else 0,
+            'sharpe_ratio': (mean - RISK_FREE_RATE) / std_dev if std_dev > 1e-9 else 0,
+            'net_profit': self.pnl,
+        }
+
+def trade_entry(profit):
+    profit = float(profit)
+    is_win = profit > 0
+    return (1, int(is_win), profit, profit if is_win else 0.0, 0.0 if is_win else -profit)
+
+def day_entry(row):
+    return (row.trades, row.wins, float(row.result), float(row.gross_profit), float(row.gross_loss))
+
+def _add_entries(a, b, sign=1):
+    return tuple(x + sign * y for x, y in zip(a, b))
+
+# Slide a window of the given size over (key, time, entry) rows in one pass, emitting the metrics
+# after every step as columnar series ready for charting.
+def rolling_series(rows, size):
+    window = RollingWindow(size)
+    series = {'time': [], 'win_rate': [], 'expectancy': [], 'profit_factor': [], 'sharpe_ratio': []}
+    for key, time, entry in rows:
+        window.push(key, entry)
+        metrics = window.metrics()
+        series['time'].append(time.isoformat())
+        for name in ('win_rate', 'expectancy', 'profit_factor', 'sharpe_ratio'):
+            series[name].append(round(metrics[name], 4))
+    return series
+
+def _trade_rows(user_id):
+    for row in cached_trade_rows(user_id, ('profit',)):
+        yield (row.open_time, row.id), row.open_time, trade_entry(row.profit)
+
+def _day_rows(user_id):
+    for row in DailyPnl.query.filter_by(user_id=user_id).order_by(DailyPnl.date):
+        yield row.date, row.date, day_entry(row)
+
+def get_rolling_series(user_id, by='trades', size=None):
+    if by == 'days':
+        return rolling_series(_day_rows(user_id), size or app.config['ROLLING_DAY_WINDOW'])
+    return rolling_series(_trade_rows(user_id), size or app.config['ROLLING_TRADE_WINDOW'])
+
+# The two live windows (last N trades, last N trading days) of one user, stamped with the data
+# version they reflect so that a worker notices writes made by other workers.
+class UserWindows:
+    __slots__ = ('version', 'trades', 'days')
+
+    def __init__(self, version, trade_window, day_window):
+        self.version = version
+        self.trades = trade_window
+        self.days = day_window
+
+_user_windows = OrderedDict()  # user_id -> UserWindows, least recently used first
+_user_windows_lock = threading.Lock()
+
+def _cached_windows(user_id):
+    with _user_windows_lock:
+        windows = _user_windows.get(user_id)
+        if windows is not None:
+            _user_windows.move_to_end(user_id)
+        return windows
+
+# Keep at most ROLLING_CACHE_USERS users' windows, evicting the least recently used.
+def _store_windows(user_id, windows):
+    with _user_windows_lock:
+        _user_windows[user_id] = windows
+        _user_windows.move_to_end(user_id)
+        while len(_user_windows) > app.config['ROLLING_CACHE_USERS']:
+            _user_windows.popitem(last=False)
+
+def _load_windows(user_id, version):
+    trade_window = RollingWindow(app.config['ROLLING_TRADE_WINDOW'])
+    recent = db.session.query(Trade.id, Trade.open_time, Trade.profit).filter_by(user_id=user_id) \
+        .order_by(Trade.open_time.desc(), Trade.id.desc()).limit(trade_window.size).all()
+    recent = [(trade_id, open_time, profit) for trade_id, open_time, profit in reversed(recent)]
+    # Fewer live trades than the window holds: the rest are in the archive
+    if len(recent) < trade_window.size and get_partitions(user_id):
+        recent = [(row.id, row.open_time, row.profit) for row in cached_trade_rows(user_id, ('profit',))[-trade_window.size:]]
+    for trade_id, open_time, profit in recent:
+        trade_window.push((open_time, trade_id), trade_entry(profit))
+
+    day_window = RollingWindow(app.config['ROLLING_DAY_WINDOW'])
+    days = DailyPnl.query.filter_by(user_id=user_id).order_by(DailyPnl.date.desc()).limit(day_window.size).all()
+    for row in reversed(days):
+        day_window.push(row.date, day_entry(row))
+    return UserWindows(version, trade_window, day_window)
+
+# Current rolling metrics of a user, reloading the last N trades / days only when another worker has
+# changed the data since this worker's windows were built.
+def get_rolling_metrics(user_id):
+    version = UserData.get_data_version(user_id)
+    windows = _cached_windows(user_id)
+    if windows is None or windows.version != version:
+        windows = _load_windows(user_id, version)
+        _store_windows(user_id, windows)
+    return {'trades': windows.trades.metrics(), 'days': windows.days.metrics()}
+
+# Apply one trade's entry to the trade window. Returns False when the change cannot be applied in
+# place (the window would need an older trade pulled back in) and the window must be reloaded.
+def _update_trade_window(window, old, new):
+    old_key = (old.open_time, old.trade_id) if old else None
+    new_key = (new.open_time, new.trade_id) if new else None
+    oldest = window.oldest_key()
+    if old and new and old_key == new_key:
+        return window.replace(new_key, trade_entry(new.profit)) or (window.is_full() and new_key < oldest)
+    if old is None:
+        if window.newest_key() is None or new_key > window.newest_key():
+            window.push(new_key, trade_entry(new.profit))
+            return True
+        return window.is_full() and new_key < oldest
+    # Deletes, and edits that move a trade in time, only leave the window untouched when both
+    # positions are older than everything in it.
+    return window.is_full() and old_key < oldest and (new_key is None or new_key < oldest)
+
+# Apply the day-level delta of one trade to the day window, under the same rules as above.
+def _update_day_window(window, snapshot, sign):
+    day = snapshot.open_time.date()
+    delta = trade_entry(snapshot.profit)
+    current = window.get(day)
+    if current is not None:
+        updated = _add_entries(current, delta, sign)
+        if updated[0] <= 0:
+            return False
+        return window.replace(day, updated)
+    if sign > 0 and (window.newest_key() is None or day > window.newest_key()):
+        window.push(day, delta)
+        return True
+    return window.is_full() and day < window.oldest_key()
+
+# Keep this worker's windows in step with a trade write that moved the data to version. Only applied
+# in place when the windows reflect the version immediately before it; anything else reloads lazily.
+def _apply_to_windows(old, new, version):
+    user_id = (new or old).user_id
+    windows = _cached_windows(user_id)
+    if windows is None:
+        return
+    applied = windows.version == version - 1 and _update_trade_window(windows.trades, old, new)
+    if applied and old is not None:
+        applied = _update_day_window(windows.days, old, -1)
+    if applied and new is not None:
+        applied = _update_day_window(windows.days, new, 1)
+    if applied:
+        windows.version = version
+    else:
+        with _user_windows_lock:
+            _user_windows.pop(user_id, None)
+
+# Hold a trade write on the session until it is committed, so the shared windows never count a
+# write that is rolled back.
+def apply_trade_to_rolling(old, new, version):
+    db.session.info.setdefault('rolling_changes', []).append((old, new, version))
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_committed_changes(session):
+    for old, new, version in session.info.pop('rolling_changes', ()):
+        _apply_to_windows(old, new, version)
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_rolled_back_changes(session):
+    session.info.pop('rolling_changes', None)
@@ -0,0 +1,330 @@
+import calendar
+from datetime import date
+from types import SimpleNamespace
+from sqlalchemy import case, func, insert
+from tradepilot import db
+from tradepilot.models import DailyPnl, Trade, TradeBreakdown
+
+# Trading sessions by UTC hour of the trade's open time, as (name, first hour, end hour).
+SESSIONS = [
+    ('Asia', 0, 7),
+    ('London', 7, 12),
+    ('New York', 12, 21),
+    ('Off-hours', 21, 24),
+]
+
+BREAKDOWN_DIMENSIONS = ('item', 'strategy', 'direction', 'session', 'hour')
+
+def session_for_hour(hour):
+    for name, start, end in SESSIONS:
+        if start <= hour < end:
+            return name
+    return SESSIONS[-1][0]
+
+# Add (sign=1) or remove (sign=-1) counter deltas on the rollup row identified by key, creating or
+# dropping the row as its trade count moves away from or back to zero.
+def _apply_counters(model, key, deltas, sign):
+    updated = model.query.filter_by(**key).update(
+        {getattr(model, column): getattr(model, column) + sign * value for column, value in deltas.items()},
+        synchronize_session=False
+    )
+    if not updated and sign > 0:
+        db.session.add(model(**key, **deltas))
+    elif sign < 0:
+        model.query.filter_by(**key).filter(model.trades <= 0).delete(synchronize_session=False)
+
+def _daily_pnl_counters(snapshot):
+    is_win = 1 if snapshot.profit > 0 else 0
+    return {'user_id': snapshot.user_id, 'date': snapshot.open_time.date()}, {
+        'trades': 1,
+        'lots': snapshot.size,
+        'result': snapshot.profit,
+        'wins': is_win,
+        'losses': 1 - is_win,
+        'gross_profit': snapshot.profit if is_win else 0,
+        'gross_loss': 0 if is_win else -snapshot.profit,
+    }
+
+def _breakdown_counters(snapshot):
+    is_win = 1 if snapshot.profit > 0 else 0
+    hour = snapshot.open_time.hour
+    return {
+        'user_id': snapshot.user_id,
+        'item': snapshot.item,
+        'strategy': snapshot.strategy,
+        'direction': snapshot.trade_type,
+        'session': session_for_hour(hour),
+        'hour': hour,
+    }, {
+        'trades': 1,
+        'wins': is_win,
+        'losses': 1 - is_win,
+        'lots': snapshot.size,
+        'gross_profit': snapshot.profit if is_win else 0,
+        'gross_loss': 0 if is_win else -snapshot.profit,
+    }
+
+def apply_trade_to_daily_pnl(snapshot, sign):
+    _apply_counters(DailyPnl, *_daily_pnl_counters(snapshot), sign)
+
+def apply_trade_to_breakdown(snapshot, sign):
+    _apply_counters(TradeBreakdown, *_breakdown_counters(snapshot), sign)
+
+# Keep the rollup tables in step with a trade write. Pass None as old for an insert and as new for a delete.
+def apply_trade_change(old, new):
+    if old is not None:
+        apply_trade_to_daily_pnl(old, -1)
+        apply_trade_to_breakdown(old, -1)
+    if new is not None:
+        apply_trade_to_daily_pnl(new, 1)
+        apply_trade_to_breakdown(new, 1)
+
+# Each rollup table with the function giving a snapshot's row key and counter deltas in it.
+ROLLUP_COUNTERS = ((DailyPnl, _daily_pnl_counters), (TradeBreakdown, _breakdown_counters))
+
+# Sum the signed counter deltas of every (old, new) pair per rollup row key.
+def _net_counters(counters, changes):
+    totals = {}
+    for old, new in changes:
+        for snapshot, sign in ((old, -1), (new, 1)):
+            if snapshot is None:
+                continue
+            key, deltas = counters(snapshot)
+            net = totals.setdefault(tuple(key.items()), dict.fromkeys(deltas, 0))
+            for column, value in deltas.items():
+                net[column] += sign * value
+    return totals
+
+# Batch version of apply_trade_change for bulk writes: the deltas of every (old, new) pair are netted
+# per rollup row first, so each row touched by the batch is written once.
+def apply_trade_changes(changes):
+    for model, counters in ROLLUP_COUNTERS:
+        totals = _net_counters(counters, changes)
+        for key, deltas in totals.items():
+            if deltas['trades'] >= 0:
+                _apply_counters(model, dict(key), deltas, 1)
+            else:
+                _apply_counters(model, dict(key), {column: -value for column, value in deltas.items()}, -1)
+
+# Users among snapshots_by_user (user_id -> snapshots of all their trades) whose stored rollup rows
+# differ from the rows those trades add up to. The stored rows are read with one query per table.
+def rollup_mismatches(snapshots_by_user):
+    mismatched = set()
+    for model, counters in ROLLUP_COUNTERS:
+        stored = {}
+        for row in db.session.query(*model.__table__.columns).filter(model.user_id.in_(list(snapshots_by_user))):
+            stored.setdefault(row.user_id, []).append(row)
+        for user_id, snapshots in snapshots_by_user.items():
+            expected = _net_counters(counters, [(None, snapshot) for snapshot in snapshots])
+            rows = stored.get(user_id, [])
+            if len(rows) != len(expected):
+                mismatched.add(user_id)
+                continue
+            key_columns = [column for column, value in next(iter(expected))] if expected else []
+            for row in rows:
+                deltas = expected.get(tuple((column, getattr(row, column)) for column in key_columns))
+                if deltas is None or any(abs(float(getattr(row, column)) - float(value)) > 1e-6 for column, value in deltas.items()):
+                    mismatched.add(user_id)
+                    break
+    return mismatched
+
+# Replace a user's rollup rows with the ones computed from snapshots of all their trades.
+def replace_rollups(user_id, snapshots):
+    clear_rollups(user_id)
+    for model, counters in ROLLUP_COUNTERS:
+        rows = [dict(key, **deltas) for key, deltas in _net_counters(counters, [(None, snapshot) for snapshot in snapshots]).items()]
+        if rows:
+            db.session.execute(insert(model), rows)
+
+# Drop the rollup rows of one user (or of everyone when user_id is None).
+def clear_rollups(user_id=None):
+    for model in (DailyPnl, TradeBreakdown):
+        query = model.query
+        if user_id is not None:
+            query = query.filter_by(user_id=user_id)
+        query.delete(synchronize_session=False)
+
+# Rebuild daily_pnl from the trade table with a single INSERT ... SELECT ... GROUP BY.
+def rebuild_daily_pnl(user_id=None):
+    query = DailyPnl.query
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    query.delete(synchronize_session=False)
+    trade_date = func.date(Trade.open_time)
+    select = db.select(
+        Trade.user_id,
+        trade_date,
+        func.count(Trade.id),
+        func.sum(Trade.size),
+        func.sum(Trade.profit),
+        func.sum(case((Trade.profit > 0, 1), else_=0)),
+        func.sum(case((Trade.profit <= 0, 1), else_=0)),
+        func.sum(case((Trade.profit > 0, Trade.profit), else_=0)),
+        func.sum(case((Trade.profit <= 0, -Trade.profit), else_=0)),
+    ).group_by(Trade.user_id, trade_date)
+    if user_id is not None:
+        select = select.where(Trade.user_id == user_id)
+    db.session.execute(insert(DailyPnl).from_select(
+        ['user_id', 'date', 'trades', 'lots', 'result', 'wins', 'losses', 'gross_profit', 'gross_loss'], select
+    ))
+    db.session.commit()
+
+# Rebuild the breakdown cube cells from the trade table, bucketing sessions in SQL.
+def rebuild_breakdown(user_id=None):
+    query = TradeBreakdown.query
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    query.delete(synchronize_session=False)
+    hour = func.extract('hour', Trade.open_time)
+    session = case(*[(hour < end, name) for name, start, end in SESSIONS[:-1]], else_=SESSIONS[-1][0])
+    strategy = func.coalesce(Trade.strategy, '')
+    select = db.select(
+        Trade.user_id,
+        Trade.item,
+        strategy,
+        Trade.trade_type,
+        session,
+        hour,
+        func.count(Trade.id),
+        func.sum(case((Trade.profit > 0, 1), else_=0)),
+        func.sum(case((Trade.profit <= 0, 1), else_=0)),
+        func.sum(Trade.size),
+        func.sum(case((Trade.profit > 0, Trade.profit), else_=0)),
+        func.sum(case((Trade.profit <= 0, -Trade.profit), else_=0)),
+    ).group_by(Trade.user_id, Trade.item, strategy, Trade.trade_type, session, hour)
+    if user_id is not None:
+        select = select.where(Trade.user_id == user_id)
+    db.session.execute(insert(TradeBreakdown).from_select(
+        ['user_id', 'item', 'strategy', 'direction', 'session', 'hour', 'trades', 'wins', 'losses', 'lots', 'gross_profit', 'gross_loss'], select
+    ))
+    db.session.commit()
+
+def rebuild_rollups(user_id=None):
+    rebuild_daily_pnl(user_id)
+    rebuild_breakdown(user_id)
+
+def _summary_row(row):
+    return {
+        'date': row.date,
+        'trades': row.trades,
+        'lots': row.lots,
+        'result': float(row.result),
+        'wins': row.wins,
+        'losses': row.losses
+    }
+
+# Daily summary rows for a user, newest first, optionally limited to a date range.
+def get_daily_pnl(user_id, start=None, end=None):
+    query = DailyPnl.query.filter_by(user_id=user_id)
+    if start is not None:
+        query = query.filter(DailyPnl.date >= start)
+    if end is not None:
+        query = query.filter(DailyPnl.date <= end)
+    return [_summary_row(row) for row in query.order_by(DailyPnl.date.desc()).all()]
+
+# Build a Monday-first month grid of P&L cells from a single range query over daily_pnl.
+def build_month_grid(user_id, year, month):
+    weeks = calendar.Calendar(firstweekday=0).monthdatescalendar(year, month)
+    days = {row['date']: row for row in get_daily_pnl(user_id, weeks[0][0], weeks[-1][-1])}
+
+    grid = []
+    for week in weeks:
+        cells = []
+        week_result = 0.0
+        week_trades = 0
+        for day in week:
+            summary = days.get(day)
+            if summary and day.month == month:
+                week_result += summary['result']
+                week_trades += summary['trades']
+            cells.append({'date': day, 'in_month': day.month == month, 'summary': summary})
+        grid.append({'days': cells, 'result': week_result, 'trades': week_trades})
+
+    month_rows = [row for row in days.values() if row['date'].month == month]
+    totals = {
+        'result': sum(row['result'] for row in month_rows),
+        'trades': sum(row['trades'] for row in month_rows),
+        'wins': sum(row['wins'] for row in month_rows),
+        'losses': sum(row['losses'] for row in month_rows),
+        'green_days': len([row for row in month_rows if row['result'] > 0]),
+        'red_days': len([row for row in month_rows if row['result'] < 0]),
+    }
+    return grid, totals
+
+# Resolve the (year, month) pair to show, falling back to the current month on bad input.
+def parse_month(year, month):
+    today = date.today()
+    try:
+        year = int(year) if year else today.year
+        month = int(month) if month else today.month
+        date(year, month, 1)
+    except ValueError:
+        return today.year, today.month
+    return year, month
+
+def shift_month(year, month, delta):
+    index = year * 12 + (month - 1) + delta
+    return index // 12, index % 12 + 1
+
+def _breakdown_row(row, dimensions):
+    gross_profit = float(row.gross_profit or 0)
+    gross_loss = float(row.gross_loss or 0)
+    net = gross_profit - gross_loss
+    result = {dimension: getattr(row, dimension) for dimension in dimensions}
+    result.update({
+        'trades': row.trades,
+        'wins': row.wins,
+        'losses': row.losses,
+        'lots': row.lots,
+        'net_profit': net,
+        'win_rate': row.wins / row.trades * 100 if row.trades else 0,
+        'expectancy': net / row.trades if row.trades else 0,
+        'profit_factor': gross_profit / gross_loss if gross_loss > 0 else 0,
+    })
+    return result
+
+# Slice the breakdown cube: group the stored cells by the requested dimensions, restricted by filters.
+def get_breakdown(user_id, dimensions, filters=None):
+    columns = [getattr(TradeBreakdown, dimension) for dimension in dimensions]
+    query = db.session.query(
+        *columns,
+        func.sum(TradeBreakdown.trades).label('trades'),
+        func.sum(TradeBreakdown.wins).label('wins'),
+        func.sum(TradeBreakdown.losses).label('losses'),
+        func.sum(TradeBreakdown.lots).label('lots'),
+        func.sum(TradeBreakdown.gross_profit).label('gross_profit'),
+        func.sum(TradeBreakdown.gross_loss).label('gross_loss'),
+    ).filter(TradeBreakdown.user_id == user_id)
+    for dimension, value in (filters or {}).items():
+        query = query.filter(getattr(TradeBreakdown, dimension) == value)
+    if columns:
+        query = query.group_by(*columns).order_by(*columns)
+    return [_breakdown_row(row, dimensions) for row in query.all() if row.trades]
+
+# Breakdown rows of a given set of trades rather than of the stored cube, e.g. the trades of one
+# report period, computed from the same counters as the breakdown rollup.
+def breakdown_of(snapshots, dimensions):
+    cells = {}
+    for key, deltas in _net_counters(_breakdown_counters, [(None, snapshot) for snapshot in snapshots]).items():
+        key = dict(key)
+        totals = cells.setdefault(tuple(key[dimension] for dimension in dimensions), dict.fromkeys(deltas, 0))
+        for column, value in deltas.items():
+            totals[column] += value
+    ordered = sorted(cells.items(), key=lambda cell: [(value is None, value) for value in cell[0]])
+    return [_breakdown_row(SimpleNamespace(**dict(zip(dimensions, group)), **totals), dimensions) for group, totals in ordered]
+
+# Parse ?by=item,session&item=NAS100 style arguments into (dimensions, filters), ignoring unknown names.
+def parse_breakdown_args(args):
+    dimensions = [name for name in (args.get('by') or 'item').split(',') if name in BREAKDOWN_DIMENSIONS]
+    filters = {}
+    for dimension in BREAKDOWN_DIMENSIONS:
+        value = args.get(dimension)
+        if value is None or value == '':
+            continue
+        if dimension == 'hour':
+            try:
+                value = int(value)
+            except ValueError:
+                continue
+        filters[dimension] = value
+    return list(dict.fromkeys(dimensions)), filters
@@ -1,11 +1,31 @@
+import json
 import os
-from flask import abort, render_template, url_for, jsonify, flash, redirect, request
+from flask import abort, render_template, url_for, jsonify, flash, redirect, request, Response
 from datetime import date, datetime, timedelta
 from tradepilot import app, db, bcrypt
+from tradepilot.archive import archived_profit, clear_archive
+from tradepilot.db_routing import mark_recent_write, read_only
 from tradepilot.forms import RegistrationForm, LoginForm, UserDataForm, UpdateProfileForm, TradeForm, CategoryForm, ItemForm, TradingPlanForm
-from tradepilot.models import ChecklistCategory, ChecklistItem, User, UserData, Trade, TradingPlan
+from tradepilot.ingest import EXCURSION_FIELDS, authenticate, backpressure, batch_status, create_api_token, queue_batch, validate_batch
+from tradepilot.models import ApiToken, ChecklistCategory, ChecklistItem, IngestBatch, User, UserData, Trade, TradingPlan
+from tradepilot.counterfactual import DEFAULT_GRID, RULE_PARAMETERS, parse_grid_args, replay_limits
+from tradepilot.montecarlo import SIMULATION_METHODS, get_or_create_run, parse_simulation_args
+from tradepilot.news import IMPACTS, news_breakdown
+from tradepilot.reports import REPORT_PERIODS, get_reports
+from tradepilot.rollups import BREAKDOWN_DIMENSIONS, apply_trade_change, build_month_grid, clear_rollups, get_breakdown, get_daily_pnl, parse_breakdown_args, parse_month, shift_month
+from tradepilot.rolling import apply_trade_to_rolling, get_rolling_metrics, get_rolling_series
+from tradepilot.rules import apply_trade_to_rule_state, clear_rule_state, evaluate_rules, get_rule_state, refresh_rules, rule_alerts
+from tradepilot.search import FACET_DIMENSIONS, SEARCH_SCOPES, search_plans, search_trades
+from tradepilot.stats import compute_stats, format_stats
+from tradepilot.series import DOWNSAMPLE_METHODS, downsample, equity_series, series_binary, series_json
+from tradepilot.tasks import ingest_trades, render_reports, run_monte_carlo
+from tradepilot.trade_cache import cached_trade_rows
 from flask_login import login_user, current_user, logout_user, login_required
+from kombu.exceptions import OperationalError
 from decimal import Decimal
+from sqlalchemy import case
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only, selectinload
 from werkzeug.utils import secure_filename
 import logging
 
@@ -19,14 +39,16 @@ def log_user_data_state(user_data, context):
 # Recalculate equity based on all trades.
 def recalculate_equity(user_data):
     trades = Trade.query.filter_by(user_id=user_data.user_id).all()
-    total_profit = sum(Decimal(trade.profit) for trade in trades)
+    total_profit = sum(Decimal(trade.profit) for trade in trades) + Decimal(archived_profit(user_data.user_id))
     user_data.equity = Decimal(user_data.balance) + total_profit
     log_user_data_state(user_data, "After recalculate_equity")
     logging.debug(f"Recalculate equity: Total Profit = {total_profit}, New Equity = {user_data.equity}")
     db.session.commit()
 
-# Update user equity based on profit delta.
+# Update user equity based on profit delta. Broker-synced accounts are left to the next sync.
 def update_equity(user_data, profit_delta):
+    if user_data.broker_synced:
+        return
     if not isinstance(user_data.equity, Decimal):
         user_data.equity = Decimal(user_data.equity)
     user_data.equity += Decimal(profit_delta)
@@ -50,151 +72,94 @@ def handle_trade_update(user_data, old_profit, new_profit):
 def handle_trade_removal(user_data, trade_profit):
     update_equity(user_data, -Decimal(trade_profit))
 
-# Calculate maximum drawdown.
-def calculate_max_drawdown(trades):
-    equity_curve = [0]  # Starting with zero for initial equity
-    for trade in trades:
-        equity_curve.append(equity_curve[-1] + float(trade.profit))
-    peak = equity_curve[0]
-    max_drawdown = 0
-    for value in equity_curve:
-        if value > peak:
-            peak = value
-        drawdown = peak - value
-        if drawdown > max_drawdown:
-            max_drawdown = drawdown
-    return max_drawdown
-
-def calculate_average_rrr(trades, max_rrr_threshold=10):
-    total_rrr = 0
-    count = 0
-
-    for trade in trades:
-        try:
-            # Ensure all necessary fields are present and numeric
-            if all(hasattr(trade, attr) and isinstance(getattr(trade, attr), (Decimal, float, int)) for attr in ['t_p', 's_l', 'price']):
-                take_profit = float(trade.t_p)
-                stop_loss = float(trade.s_l)
-                entry_price = float(trade.price)
-
-                # Ensure stop_loss and entry_price are not equal to avoid division by zero
-                if stop_loss != entry_price:
-                    rrr = abs(take_profit - entry_price) / abs(stop_loss - entry_price)
-                    # Filter out extremely high RRR values
-                    if rrr <= max_rrr_threshold:
-                        total_rrr += rrr
-                        count += 1
-        except (AttributeError, ValueError):
-            # Skip trades with missing or invalid attributes
-            continue
-
-    return total_rrr / count if count > 0 else 0
-
-# Calculate expectancy.
-def calculate_expectancy(trades):
-    total_profit = sum(float(trade.profit) for trade in trades)
-    return total_profit / len(trades) if trades else 0
-
-# Calculate profit factor.
-def calculate_profit_factor(trades):
-    total_gains = sum(float(trade.profit) for trade in trades if trade.profit > 0)
-    total_losses = abs(sum(float(trade.profit) for trade in trades if trade.profit < 0))
-    return total_gains / total_losses if total_losses > 0 else 0
-
-# Calculate Sharpe ratio.
-def calculate_sharpe_ratio(trades, risk_free_rate=0.02):
-    returns = [float(trade.profit) for trade in trades]
-    avg_return = sum(returns) / len(returns) if returns else 0
-    std_dev = (sum([(x - avg_return) ** 2 for x in returns]) / len(returns)) ** 0.5 if returns else 1
-    return (avg_return - risk_free_rate) / std_dev if std_dev != 0 else 0
-
-# Generate daily summary.
-def get_daily_summary(trades):
-    summary = {}
-    for trade in trades:
-        trade_date = trade.open_time.date()
-        if trade_date not in summary:
-            summary[trade_date] = {'trades': 0, 'lots': 0, 'result': 0}
-        summary[trade_date]['trades'] += 1
-        summary[trade_date]['lots'] += float(trade.size)
-        summary[trade_date]['result'] += float(trade.profit)
-    return [{'date': date, 'trades': data['trades'], 'lots': data['lots'], 'result': data['result']} for date, data in sorted(summary.items(), reverse=True)]
+# Lock the user's account row until the transaction ends. Trade writes from the web, the ingestion task
+# and the archival all take it before touching trades, so their rollup updates never race to insert
+# the same row.
+def lock_trade_writes(user_id):
+    UserData.query.filter_by(user_id=user_id).with_for_update().first()
+
+# Propagate a trade write to the rollup tables, the rule state and (once committed) the rolling windows.
+# The caller holds lock_trade_writes.
+# Pass None as old for an insert and as new for a delete.
+def handle_trade_write(old_snapshot, new_snapshot):
+    user_id = (new_snapshot or old_snapshot).user_id
+    mark_recent_write()
+    apply_trade_change(old_snapshot, new_snapshot)
+    apply_trade_to_rule_state(old_snapshot, new_snapshot)
+    version = UserData.bump_data_version(user_id)
+    if new_snapshot is not None:
+        # Stamp the trade so per-worker trade caches pick the write up incrementally
+        Trade.query.filter_by(id=new_snapshot.trade_id).update({Trade.data_version: version}, synchronize_session=False)
+    apply_trade_to_rolling(old_snapshot, new_snapshot, version)
+
+# Flash every prop-firm rule that is close to or past its limit.
+def flash_rule_alerts(user_id):
+    for rule in rule_alerts(user_id):
+        category = 'danger' if rule['status'] == 'breach' else 'warning'
+        flash(f"{rule['rule']}: {rule['value']} of {rule['limit']}", category)
+
+# Generate daily summary from the pre-aggregated daily_pnl rollup.
+def get_daily_summary(user_id):
+    return get_daily_pnl(user_id)
+
+# Load a user's checklist categories together with their items (one query for each table).
+def get_checklist_categories(user_id):
+    return ChecklistCategory.query.options(selectinload(ChecklistCategory.items)).filter_by(user_id=user_id).all()
 
 def get_latest_trading_plan_id(user_id):
-    latest_plan = TradingPlan.query.filter_by(user_id=user_id).order_by(TradingPlan.date.desc()).first()
-    return latest_plan.id if latest_plan else None
+    return db.session.query(TradingPlan.id).filter_by(user_id=user_id).order_by(TradingPlan.date.desc()).limit(1).scalar()
 
+# Direct lookup through the unique (user_id, date) index.
 def get_today_trading_plan(user_id):
-    today = date.today()
-    print(f"Checking for trading plan on: {today}")  # Log today's date
-    plans = TradingPlan.query.filter_by(user_id=user_id).all()
-    for plan in plans:
-        print(f"Existing plan date: {plan.date}, Today's date: {today}")  # Log each plan's date
-        if plan.date == today:
-            return plan
-    return None
+    return TradingPlan.query.filter_by(user_id=user_id, date=date.today()).first()
+
+# One page of a user's plans, newest first, continuing before the given date (keyset pagination).
+# Only the summary columns are loaded; the large text columns stay deferred.
+def get_trading_plan_page(user_id, before=None, page_size=30):
+    query = TradingPlan.query.options(load_only(TradingPlan.id, TradingPlan.user_id, TradingPlan.date)).filter_by(user_id=user_id)
+    if before is not None:
+        query = query.filter(TradingPlan.date < before)
+    plans = query.order_by(TradingPlan.date.desc()).limit(page_size + 1).all()
+    next_before = plans[page_size - 1].date if len(plans) > page_size else None
+    return plans[:page_size], next_before
 
 @app.route('/')
 @app.route('/dashboard')
 @login_required
+@read_only
 def index():
     user_data = UserData.query.filter_by(user_id=current_user.id).first()
 
-    if user_data:
-        # Ensure balance is updated from equity at the start of a new day
-        sync_balance_from_equity(user_data)
-
     last_ten_trades = Trade.query.filter_by(user_id=current_user.id).order_by(Trade.open_time.desc()).limit(10).all()
-    trades = Trade.query.filter_by(user_id=current_user.id).all()
-
-    # Calculate statistics
-    total_trades = len(trades)
-    winning_trades = len([trade for trade in trades if trade.profit > 0])
-    losing_trades = len([trade for trade in trades if trade.profit <= 0])
-    win_rate = (winning_trades / total_trades * 100) if total_trades > 0 else 0
-    average_profit = sum(trade.profit for trade in trades if trade.profit > 0) / winning_trades if winning_trades > 0 else 0
-    average_loss = sum(trade.profit for trade in trades if trade.profit <= 0) / losing_trades if losing_trades > 0 else 0
-    net_profit = sum(trade.profit for trade in trades)
-    max_drawdown = calculate_max_drawdown(trades)
-    average_rrr = calculate_average_rrr(trades)
-    lots = sum(trade.size for trade in trades)
-    expectancy = calculate_expectancy(trades)
-    profit_factor = calculate_profit_factor(trades)
-    sharpe_ratio = calculate_sharpe_ratio(trades)
+    # Archived trades included, as lightweight rows carrying only the columns the stats use
+    trades = cached_trade_rows(current_user.id, ('profit', 'size', 'price', 's_l', 't_p'))
+
+    stats = format_stats(compute_stats(trades))
 
     # Daily summary
-    daily_summaries = get_daily_summary(trades)
+    daily_summaries = get_daily_summary(current_user.id)
+
+    # Prop-firm rule status from the running rule state
+    rule_statuses = evaluate_rules(get_rule_state(current_user.id)) if user_data else []
+
+    # Rolling metrics over the last N trades and the last N trading days
+    rolling_metrics = get_rolling_metrics(current_user.id)
 
     # Use database values for balance and equity and format to 2 decimal places
     balance = round(user_data.balance, 2) if user_data else Decimal(0)
     equity = round(user_data.equity, 2) if user_data else Decimal(0)
 
-    # Format the values
-    win_rate = f"{win_rate:.2f}%"
-    average_rrr = f"{average_rrr:.2f}"
-    expectancy = f"${expectancy:.2f}"
-    profit_factor = f"{profit_factor:.2f}"
-    sharpe_ratio = f"{sharpe_ratio:.2f}"
-
     return render_template('index.html',
                            user_data=user_data,
                            last_ten_trades=last_ten_trades,
-                           total_trades=total_trades,
-                           winning_trades=winning_trades,
-                           losing_trades=losing_trades,
-                           win_rate=win_rate,
-                           average_profit=average_profit,
-                           average_loss=average_loss,
-                           net_profit=net_profit,
-                           max_drawdown=max_drawdown,
-                           average_rrr=average_rrr,
-                           lots=lots,
-                           expectancy=expectancy,
-                           profit_factor=profit_factor,
-                           sharpe_ratio=sharpe_ratio,
                            daily_summaries=daily_summaries,
+                           rule_statuses=rule_statuses,
+                           rolling_metrics=rolling_metrics,
+                           rolling_trade_window=app.config['ROLLING_TRADE_WINDOW'],
+                           rolling_day_window=app.config['ROLLING_DAY_WINDOW'],
                            equity=f"{equity:.2f}",  # Format to 2 decimal places
-                           balance=f"{balance:.2f}")  # Format to 2 decimal places
+                           balance=f"{balance:.2f}",  # Format to 2 decimal places
+                           **stats)
 
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -221,10 +186,14 @@ def login():
         if user and bcrypt.check_password_hash(user.password_hash, form.password.data):
             login_user(user, remember=form.remember.data)
 
-            # Recalculate equity for the user on login
+            # Recalculate equity for the user on login and roll the balance forward to it. This runs
+            # here on the primary rather than on the dashboard, which may read a lagging replica.
+            # Accounts synced from their broker keep the broker's figures.
             user_data = UserData.query.filter_by(user_id=user.id).first()
-            if user_data:
+            if user_data and not user_data.broker_synced:
                 recalculate_equity(user_data)
+                sync_balance_from_equity(user_data)
+                mark_recent_write()
 
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('index'))
@@ -251,7 +220,24 @@ def profile():
         form.full_name.data = current_user.full_name
         form.email.data = current_user.email
         form.mood.data = current_user.mood
-    return render_template('profile.html', form=form)
+    api_tokens = ApiToken.query.filter_by(user_id=current_user.id).order_by(ApiToken.created_at).all()
+    return render_template('profile.html', form=form, api_tokens=api_tokens)
+
+@app.route('/api_tokens', methods=['POST'])
+@login_required
+def create_token():
+    name = request.form.get('name', '').strip()[:100] or 'Expert Advisor'
+    token = create_api_token(current_user.id, name)
+    flash(f'API token "{name}" created. Copy it now, it will not be shown again: {token}', 'success')
+    return redirect(url_for('profile'))
+
+@app.route('/api_tokens/<int:token_id>/delete', methods=['POST'])
+@login_required
+def delete_token(token_id):
+    ApiToken.query.filter_by(id=token_id, user_id=current_user.id).delete()
+    db.session.commit()
+    flash('API token revoked.', 'success')
+    return redirect(url_for('profile'))
 
 @app.route('/logout')
 def logout():
@@ -273,6 +259,7 @@ def edit():
     if form.validate_on_submit():
         user_data.broker_name = form.broker_name.data
         user_data.platform = form.platform.data
+        user_data.broker_account = form.broker_account.data or None
         user_data.equity = form.equity.data
         user_data.balance = form.balance.data
         user_data.min_trading_days = form.min_trading_days.data
@@ -288,12 +275,15 @@ def edit():
         user_data.timeframes = form.timeframes.data
         user_data.trades_per_day = form.trades_per_day.data
         db.session.add(user_data)
+        refresh_rules(user_data)
         db.session.commit()
+        mark_recent_write()
         flash('Your data has been updated!', 'success')
         return redirect(url_for('index'))
     elif request.method == 'GET':
         form.broker_name.data = user_data.broker_name
         form.platform.data = user_data.platform
+        form.broker_account.data = user_data.broker_account
         form.equity.data = user_data.equity
         form.balance.data = user_data.balance
         form.min_trading_days.data = user_data.min_trading_days
@@ -318,8 +308,205 @@ def daily():
 
 @app.route('/calendar')
 @login_required
+@read_only
 def calendar():
-    return render_template('calendar.html')
+    year, month = parse_month(request.args.get('year'), request.args.get('month'))
+    weeks, month_totals = build_month_grid(current_user.id, year, month)
+    return render_template('calendar.html',
+                           weeks=weeks,
+                           month_totals=month_totals,
+                           month_start=date(year, month, 1),
+                           prev_month=shift_month(year, month, -1),
+                           next_month=shift_month(year, month, 1))
+
+@app.route('/breakdown')
+@login_required
+@read_only
+def breakdown():
+    dimensions, filters = parse_breakdown_args(request.args)
+    rows = get_breakdown(current_user.id, dimensions, filters)
+    if request.args.get('format') == 'json':
+        return jsonify({'dimensions': dimensions, 'filters': filters, 'rows': rows})
+    return render_template('breakdown.html',
+                           rows=rows,
+                           dimensions=dimensions,
+                           filters=filters,
+                           all_dimensions=BREAKDOWN_DIMENSIONS)
+
+# What the journal would have made under the user's own day limits, and under a grid of alternatives.
+@app.route('/counterfactual')
+@login_required
+@read_only
+def counterfactual():
+    user_data = UserData.query.filter_by(user_id=current_user.id).first()
+    grid_args = {parameter: request.args.get(parameter, '') for parameter in RULE_PARAMETERS}
+    try:
+        grid = parse_grid_args(grid_args, user_data.balance if user_data else 0)
+    except ValueError as e:
+        if request.args.get('format') == 'json':
+            return jsonify({'error': str(e)}), 400
+        flash(str(e), 'danger')
+        grid = parse_grid_args({}, user_data.balance if user_data else 0)
+    result = replay_limits(current_user.id, get_rule_state(current_user.id) if user_data else None, grid)
+    if request.args.get('format') == 'json':
+        return jsonify(result)
+    defaults = {parameter: ','.join('none' if value is None else str(value) for value in DEFAULT_GRID[parameter]) for parameter in RULE_PARAMETERS}
+    return render_template('counterfactual.html', result=result, grid_args=grid_args, defaults=defaults)
+
+# P&L of trades held through economic news versus the rest.
+@app.route('/news')
+@login_required
+@read_only
+def news():
+    impact = request.args.get('impact', 'high')
+    if impact not in IMPACTS:
+        impact = 'high'
+    result = news_breakdown(current_user.id, impact)
+    if request.args.get('format') == 'json':
+        return jsonify(result)
+    return render_template('news.html', result=result, impacts=IMPACTS, window=app.config['NEWS_WINDOW_MINUTES'])
+
+@app.route('/reports')
+@login_required
+@read_only
+def reports():
+    period = request.args.get('period')
+    if period not in REPORT_PERIODS:
+        period = None
+    return render_template('reports.html', reports=get_reports(current_user.id, period), period=period, periods=REPORT_PERIODS)
+
+# Queue a render of the user's current reports instead of waiting for the beat schedule.
+@app.route('/reports/refresh', methods=['POST'])
+@login_required
+def refresh_reports():
+    try:
+        render_reports.delay(current_user.id)
+    except OperationalError:
+        flash('The report queue is unavailable, please try again later.', 'danger')
+        return redirect(url_for('reports'))
+    flash('Your reports are being generated and will show up here shortly.', 'success')
+    return redirect(url_for('reports'))
+
+@app.route('/rolling_metrics')
+@login_required
+@read_only
+def rolling_metrics():
+    by = 'days' if request.args.get('by') == 'days' else 'trades'
+    size = request.args.get('window', type=int)
+    if size is not None and not 1 <= size <= 1000:
+        return jsonify({'error': 'window must be between 1 and 1000'}), 400
+    return jsonify({'by': by, 'current': get_rolling_metrics(current_user.id), 'series': get_rolling_series(current_user.id, by, size)})
+
+@app.route('/equity_curve')
+@login_required
+@read_only
+def equity_curve():
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d') if request.args.get('start') else None
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1) - timedelta(seconds=1) if request.args.get('end') else None
+    except ValueError:
+        return jsonify({'error': 'Dates must be formatted as YYYY-MM-DD'}), 400
+    points = request.args.get('points', 1000, type=int)
+    method = request.args.get('method', 'lttb')
+    if not 10 <= points <= 10000 or method not in DOWNSAMPLE_METHODS:
+        return jsonify({'error': 'points must be between 10 and 10000 and method one of lttb, minmax'}), 400
+
+    times, equity, drawdown = equity_series(current_user.id, start, end)
+    total_points = len(times)
+    times, equity, drawdown = downsample(times, equity, drawdown, points, method)
+    if request.args.get('format') == 'binary':
+        return Response(series_binary(times, equity, drawdown), mimetype='application/octet-stream',
+                        headers={'X-Total-Points': str(total_points)})
+    return jsonify(series_json(times, equity, drawdown, total_points))
+
+# Ranked full-text search over trade comments/strategies and trading plan notes, faceted by
+# instrument and strategy for trades.
+@app.route('/search')
+@login_required
+@read_only
+def search():
+    query = request.args.get('q', '').strip()
+    scope = request.args.get('scope') if request.args.get('scope') in SEARCH_SCOPES else 'trades'
+    page = max(request.args.get('page', 1, type=int), 1)
+    filters = {dimension: request.args.get(dimension) for dimension in FACET_DIMENSIONS if request.args.get(dimension)}
+    if scope == 'plans':
+        results = search_plans(current_user.id, query, page)
+    else:
+        results = search_trades(current_user.id, query, page, filters)
+    if request.args.get('format') == 'json':
+        return jsonify(dict(results, query=query, scope=scope, filters=filters))
+    return render_template('search.html', results=results, query=query, scope=scope, filters=filters)
+
+# Batch trade push for expert advisors, authenticated with an API token. Batches are validated here and
+# upserted by the ingest_trades task; when too many batches are queued the client is told to back off.
+@app.route('/api/v1/trades', methods=['POST'])
+def api_push_trades():
+    api_token = authenticate(request.headers.get('Authorization'))
+    if not api_token:
+        return jsonify({'error': 'Invalid or missing API token'}), 401
+    payload = request.get_json(silent=True)
+    items = payload.get('trades') if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Expected a JSON list of trades or {"trades": [...]}'}), 400
+    if len(items) > app.config['INGEST_MAX_BATCH']:
+        return jsonify({'error': f"At most {app.config['INGEST_MAX_BATCH']} trades per request"}), 413
+    rows, errors = validate_batch(items)
+    if errors:
+        return jsonify({'error': 'Invalid trades', 'errors': errors}), 400
+    if not UserData.query.filter_by(user_id=api_token.user_id).first():
+        return jsonify({'error': 'Set your balance and equity before pushing trades'}), 400
+
+    retry_after = backpressure(api_token.user_id)
+    if retry_after:
+        response = jsonify({'error': 'Too many batches queued, retry later', 'retry_after': retry_after})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 429
+    batch = queue_batch(api_token.user_id, rows)
+    try:
+        ingest_trades.delay(batch.id)
+    except OperationalError:
+        db.session.delete(batch)
+        db.session.commit()
+        return jsonify({'error': 'The ingestion queue is unavailable, try again later'}), 503
+    return jsonify({'batch_id': batch.id, 'status': 'pending', 'trades': len(rows),
+                    'status_url': url_for('api_batch_status', batch_id=batch.id)}), 202
+
+@app.route('/api/v1/batches/<int:batch_id>')
+def api_batch_status(batch_id):
+    api_token = authenticate(request.headers.get('Authorization'))
+    if not api_token:
+        return jsonify({'error': 'Invalid or missing API token'}), 401
+    batch = IngestBatch.query.filter_by(id=batch_id, user_id=api_token.user_id).first()
+    if not batch:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(batch_status(batch))
+
+@app.route('/risk')
+@login_required
+def risk():
+    return render_template('risk.html', methods=SIMULATION_METHODS)
+
+# Monte Carlo risk-of-ruin result for the given parameters. Served from the cache when the user's data
+# has not changed since it was computed; otherwise the simulation is queued and 202 is returned so the
+# client can poll.
+@app.route('/risk/monte_carlo')
+@login_required
+def monte_carlo():
+    try:
+        params = parse_simulation_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    run, needs_queueing = get_or_create_run(current_user.id, params)
+    if run.status == 'done':
+        return jsonify(json.loads(run.result))
+    if needs_queueing:
+        try:
+            run_monte_carlo.delay(run.id)
+        except OperationalError:
+            db.session.delete(run)
+            db.session.commit()
+            return jsonify({'error': 'The simulation queue is unavailable, try again later'}), 503
+    return jsonify({'status': 'pending'}), 202
 
 @app.route('/upload_file', methods=['POST'])
 @login_required
@@ -371,7 +558,10 @@ def add_trade():
         )
         new_trade.calculate_pips()
         new_trade.calculate_duration()
+        lock_trade_writes(current_user.id)
         db.session.add(new_trade)
+        db.session.flush()  # Assign the trade id before taking the snapshot
+        handle_trade_write(None, new_trade.snapshot())
         db.session.commit()
 
         # Update equity after adding a new trade
@@ -379,6 +569,7 @@ def add_trade():
         db.session.commit()  # Commit changes after updating equity
 
         flash('Your trade has been added!', 'success')
+        flash_rule_alerts(current_user.id)
         return redirect(url_for('index'))
     return render_template('add_trade.html', title='Add Trade', form=form)
 
@@ -388,7 +579,11 @@ def edit_trade(trade_id):
     trade = Trade.query.get_or_404(trade_id)
     form = TradeForm(obj=trade)
     if form.validate_on_submit():
+        lock_trade_writes(trade.user_id)
+        db.session.refresh(trade, with_for_update=True)  # Snapshot the row as committed, not as first read
         old_profit = trade.profit  # Store old profit before updating
+        old_snapshot = trade.snapshot()
+        old_excursion_values = [getattr(trade, field) for field in EXCURSION_FIELDS]
 
         trade.ticket = form.ticket.data
         trade.open_time = form.open_time.data
@@ -414,6 +609,9 @@ def edit_trade(trade_id):
 
         trade.calculate_pips()
         trade.calculate_duration()
+        if [getattr(trade, field) for field in EXCURSION_FIELDS] != old_excursion_values:
+            trade.mae = trade.mfe = None  # Recomputed from the bar store
+        handle_trade_write(old_snapshot, trade.snapshot())
         db.session.commit()
 
         # Update equity after editing a trade
@@ -423,6 +621,7 @@ def edit_trade(trade_id):
             db.session.commit()  # Commit changes after updating equity
 
         flash('Your trade has been updated!', 'success')
+        flash_rule_alerts(current_user.id)
         return redirect(url_for('trades'))
     return render_template('edit_trade.html', title='Edit Trade', form=form, trade=trade)
 
@@ -444,13 +643,18 @@ def delete_trade(trade_id):
         handle_trade_removal(user_data, trade.profit)
         db.session.commit()  # Commit changes after updating equity
 
+    lock_trade_writes(trade.user_id)
+    db.session.refresh(trade, with_for_update=True)
+    old_snapshot = trade.snapshot()
     db.session.delete(trade)
+    handle_trade_write(old_snapshot, None)
     db.session.commit()
     flash('Your trade has been deleted!', 'success')
     return redirect(url_for('trades'))
 
 @app.route('/trades', methods=['GET', 'POST'])
 @login_required
+@read_only
 def trades():
     user_data = UserData.query.filter_by(user_id=current_user.id).first()
     if request.method == 'POST':
@@ -528,6 +732,7 @@ def reset():
         # Reset user data fields
         user_data.broker_name = ''
         user_data.platform = ''
+        user_data.broker_account = None
         user_data.equity = 0.0
         user_data.balance = 0.0
         user_data.min_trading_days = None
@@ -546,7 +751,12 @@ def reset():
 
         # Delete all trades for the user
         Trade.query.filter_by(user_id=current_user.id).delete()
+        clear_archive(current_user.id)
+        clear_rollups(current_user.id)
+        clear_rule_state(current_user.id)
+        UserData.bump_data_version(current_user.id)
         db.session.commit()
+        mark_recent_write()
 
         flash('All data have been reset to default.', 'success')
     else:
@@ -556,9 +766,9 @@ def reset():
 @app.route('/checklist_settings', methods=['GET', 'POST'])
 @login_required
 def checklist_settings():
+    categories = get_checklist_categories(current_user.id)
     category_form = CategoryForm()
-    item_form = ItemForm()
-    categories = ChecklistCategory.query.filter_by(user_id=current_user.id).all()
+    item_form = ItemForm(categories=categories)
 
     if category_form.validate_on_submit() and 'add_category' in request.form:
         new_category = ChecklistCategory(name=category_form.name.data, user_id=current_user.id)
@@ -579,9 +789,30 @@ def checklist_settings():
 @app.route('/trading_checklist')
 @login_required
 def trading_checklist():
-    categories = ChecklistCategory.query.filter_by(user_id=current_user.id).all()
+    categories = get_checklist_categories(current_user.id)
     return render_template('checklist.html', categories=categories)
 
+# Persist a batch of checklist ticks, e.g. {"items": {"12": true, "13": false}}, with a single UPDATE.
+# The body is parsed as JSON whatever its content type, since beacons are sent as text/plain.
+@app.route('/checklist/state', methods=['POST'])
+@login_required
+def update_checklist_state():
+    data = request.get_json(force=True, silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, dict) or not items:
+        return jsonify({'error': 'Invalid data'}), 400
+    try:
+        states = {int(item_id): bool(completed) for item_id, completed in items.items()}
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid data'}), 400
+
+    updated = ChecklistItem.query.filter(
+        ChecklistItem.user_id == current_user.id,
+        ChecklistItem.id.in_(states.keys())
+    ).update({ChecklistItem.completed: case(states, value=ChecklistItem.id)}, synchronize_session=False)
+    db.session.commit()
+    return jsonify({'success': True, 'updated': updated})
+
 @app.route('/delete_category/<int:category_id>', methods=['POST'])
 @login_required
 def delete_category(category_id):
@@ -640,7 +871,14 @@ def add_trading_plan():
             image6=uploaded_files[5] if len(uploaded_files) > 5 else None
         )
         db.session.add(plan)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another request created today's plan in the meantime
+            db.session.rollback()
+            existing_plan = get_today_trading_plan(current_user.id)
+            flash('A trading plan already exists for today. Please edit the existing plan.', 'warning')
+            return redirect(url_for('edit_trading_plan', plan_id=existing_plan.id))
         flash('Trading plan added successfully!', 'success')
         return redirect(url_for('trading_plan_history'))
     return render_template('add_trading_plan.html', form=form)
@@ -694,8 +932,12 @@ def view_trading_plan(plan_id):
 @app.route('/trading_plan_history', methods=['GET'])
 @login_required
 def trading_plan_history():
-    plans = TradingPlan.query.filter_by(user_id=current_user.id).all()
-    return render_template('trading_plan_history.html', plans=plans)
+    try:
+        before = datetime.strptime(request.args['before'], '%Y-%m-%d').date() if request.args.get('before') else None
+    except ValueError:
+        before = None
+    plans, next_before = get_trading_plan_page(current_user.id, before)
+    return render_template('trading_plan_history.html', plans=plans, next_before=next_before)
 
 @app.route('/today_trading_plan')
 @login_required
@@ -721,10 +963,6 @@ def delete_trading_plan(plan_id):
 
 @app.context_processor
 def inject_user_data():
-    def get_latest_trading_plan_id(user_id):
-        latest_plan = TradingPlan.query.filter_by(user_id=user_id).order_by(TradingPlan.date.desc()).first()
-        return latest_plan.id if latest_plan else None
-
     if current_user.is_authenticated:
         user_data = UserData.query.filter_by(user_id=current_user.id).first()
         return dict(user_data=user_data, current_user=current_user, get_latest_trading_plan_id=get_latest_trading_plan_id)
@@ -0,0 +1,194 @@
+import re
+from datetime import date, datetime, time
+from decimal import Decimal, InvalidOperation
+from tradepilot import db
+from tradepilot.archive import trade_rows
+from tradepilot.models import RuleState, UserData
+
+# Share of a limit at which a rule starts warning instead of reporting ok.
+WARNING_RATIO = Decimal('0.8')
+
+NUMBER_PATTERN = re.compile(r'-?\d+(?:\.\d+)?')
+
+# Parse a free-text money limit such as "500", "$1,000" or "5%" into an absolute amount.
+# Percentages are taken of the account balance at the time the rules are parsed.
+def parse_limit(text, balance):
+    if text is None:
+        return None
+    text = str(text).replace(',', '')
+    match = NUMBER_PATTERN.search(text)
+    if not match:
+        return None
+    try:
+        amount = abs(Decimal(match.group()))
+    except InvalidOperation:
+        return None
+    if '%' in text:
+        amount = Decimal(balance or 0) * amount / 100
+    return amount.quantize(Decimal('0.01')) if amount > 0 else None
+
+# Parse a free-text count such as "3" or "3 trades".
+def parse_count(text):
+    if text is None:
+        return None
+    match = NUMBER_PATTERN.search(str(text))
+    if not match:
+        return None
+    count = abs(int(Decimal(match.group())))
+    return count if count > 0 else None
+
+# Copy the user's free-text limits into the typed columns of the rule state.
+def parse_rules(state, user_data):
+    balance = user_data.balance if user_data else 0
+    for field in ('max_daily_loss', 'daily_max_loss', 'max_loss', 'profit_target'):
+        setattr(state, field, parse_limit(getattr(user_data, field, None), balance))
+    for field in ('consecutive_losers', 'trades_per_day', 'min_trading_days'):
+        setattr(state, field, parse_count(getattr(user_data, field, None)))
+
+def _reset_running_state(state):
+    state.day = None
+    state.day_pnl = Decimal(0)
+    state.day_trades = 0
+    state.losing_streak = 0
+    state.total_pnl = Decimal(0)
+    state.equity_high = Decimal(0)
+    state.trading_days = 0
+    state.last_trade_time = None
+    state.day_start_high = Decimal(0)
+    state.day_start_streak = 0
+
+# Advance the running state by one trade. Trades must be fed in open_time order.
+def _advance(state, open_time, profit):
+    trade_day = open_time.date()
+    if state.day != trade_day:
+        state.day = trade_day
+        state.day_start_high = state.equity_high
+        state.day_start_streak = state.losing_streak
+        state.day_pnl = Decimal(0)
+        state.day_trades = 0
+        state.trading_days += 1
+    state.day_pnl += profit
+    state.day_trades += 1
+    state.losing_streak = state.losing_streak + 1 if profit <= 0 else 0
+    state.total_pnl += profit
+    if state.total_pnl > state.equity_high:
+        state.equity_high = state.total_pnl
+    state.last_trade_time = open_time
+
+# Rebuild a user's running state from scratch by replaying every trade, archived ones included, in open_time order.
+# The limits are only parsed when the state is first created or through refresh_rules. Callers that
+# already hold the user's trades (open_time, profit rows in order) can pass them as rows. A state
+# created with persist=False is left out of the session.
+def replay_rule_state(user_id, rows=None, persist=True):
+    state = RuleState.query.filter_by(user_id=user_id).first()
+    if not state:
+        state = RuleState(user_id=user_id)
+        parse_rules(state, UserData.query.filter_by(user_id=user_id).first())
+        if persist:
+            db.session.add(state)
+    _reset_running_state(state)
+    for row in trade_rows(user_id, ('profit',)) if rows is None else rows:
+        _advance(state, row.open_time, Decimal(row.profit))
+    return state
+
+# A user's rule state, created on first use. Read-only views on the replica, which may not have the
+# state yet, get it worked out without writing it.
+def get_rule_state(user_id):
+    state = RuleState.query.filter_by(user_id=user_id).first()
+    return state if state else replay_rule_state(user_id, persist=not db.session.info.get('use_replica'))
+
+# Re-parse the limits after the user edits their account settings.
+def refresh_rules(user_data):
+    state = RuleState.query.filter_by(user_id=user_data.user_id).first()
+    if state:
+        parse_rules(state, user_data)
+    else:
+        replay_rule_state(user_data.user_id)
+
+# Whether every trade written (before and after the write) falls on the state's current day, which
+# replay_day can settle without the rest of the history.
+def _on_current_day(state, changes):
+    if state.day is None or state.day_start_high is None:
+        return False
+    return all(snapshot.open_time.date() == state.day for change in changes for snapshot in change if snapshot is not None)
+
+# Rewind the state to the start of its current day and advance it through that day's trades again.
+# Returns False, leaving the state for a full replay, when the day has no trades left.
+def replay_day(state):
+    day = state.day
+    rows = trade_rows(state.user_id, ('profit',), datetime.combine(day, time.min), datetime.combine(day, time.max))
+    if not rows:
+        return False
+    state.total_pnl -= state.day_pnl
+    state.equity_high = state.day_start_high
+    state.losing_streak = state.day_start_streak
+    state.trading_days -= 1
+    state.day = None
+    for row in rows:
+        _advance(state, row.open_time, Decimal(row.profit))
+    return True
+
+# Keep the rule state in step with a trade write. Appending the newest trade is O(1); edits, deletes
+# and back-dated inserts on the state's current day replay that day only; anything earlier can change
+# the streak and the equity high of every later day, so it falls back to a full replay.
+# Must be called after the write is in the session so a replay sees it.
+def apply_trade_to_rule_state(old, new):
+    apply_trade_batch_to_rule_state((new or old).user_id, [(old, new)])
+
+# Batch version of apply_trade_to_rule_state for bulk writes of one user's trades: a batch of inserts
+# that all come after the last trade the state has seen is advanced in open_time order, writes all on
+# the current day replay that day, anything else is settled with a single replay.
+def apply_trade_batch_to_rule_state(user_id, changes):
+    if not changes:
+        return
+    state = RuleState.query.filter_by(user_id=user_id).first()
+    inserts = sorted((new for old, new in changes if old is None), key=lambda snapshot: (snapshot.open_time, snapshot.trade_id))
+    if state and len(inserts) == len(changes) and (state.last_trade_time is None or inserts[0].open_time >= state.last_trade_time):
+        for snapshot in inserts:
+            _advance(state, snapshot.open_time, snapshot.profit)
+    elif not (state and _on_current_day(state, changes) and replay_day(state)):
+        replay_rule_state(user_id)
+
+def clear_rule_state(user_id):
+    RuleState.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+def _limit_status(value, limit):
+    if value >= limit:
+        return 'breach'
+    if value >= limit * WARNING_RATIO:
+        return 'warning'
+    return 'ok'
+
+def _rule(label, value, limit, status):
+    return {'rule': label, 'value': value, 'limit': limit, 'status': status}
+
+# Evaluate every configured rule against the running state. Status is one of ok, warning, breach or met.
+def evaluate_rules(state, today=None):
+    today = today or date.today()
+    is_today = state.day == today
+    day_loss = -state.day_pnl if is_today and state.day_pnl < 0 else Decimal(0)
+    day_trades = state.day_trades if is_today else 0
+    drawdown = state.equity_high - state.total_pnl
+
+    results = []
+    if state.max_daily_loss:
+        results.append(_rule('Max Daily Loss', day_loss, state.max_daily_loss, _limit_status(day_loss, state.max_daily_loss)))
+    if state.daily_max_loss:
+        results.append(_rule('Daily Max Loss', day_loss, state.daily_max_loss, _limit_status(day_loss, state.daily_max_loss)))
+    if state.max_loss:
+        results.append(_rule('Max Loss (trailing)', drawdown, state.max_loss, _limit_status(drawdown, state.max_loss)))
+    if state.consecutive_losers:
+        status = 'breach' if state.losing_streak >= state.consecutive_losers else 'warning' if state.consecutive_losers > 1 and state.losing_streak == state.consecutive_losers - 1 else 'ok'
+        results.append(_rule('Consecutive Losers', state.losing_streak, state.consecutive_losers, status))
+    if state.trades_per_day:
+        status = 'breach' if day_trades > state.trades_per_day else 'warning' if day_trades == state.trades_per_day else 'ok'
+        results.append(_rule('Trades Per Day', day_trades, state.trades_per_day, status))
+    if state.profit_target:
+        results.append(_rule('Profit Target', state.total_pnl, state.profit_target, 'met' if state.total_pnl >= state.profit_target else 'ok'))
+    if state.min_trading_days:
+        results.append(_rule('Min Trading Days', state.trading_days, state.min_trading_days, 'met' if state.trading_days >= state.min_trading_days else 'ok'))
+    return results
+
+# Rules currently in warning or breach, for flashing after a trade write.
+def rule_alerts(user_id):
+    return [rule for rule in evaluate_rules(get_rule_state(user_id)) if rule['status'] in ('warning', 'breach')]
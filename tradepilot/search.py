@@ -0,0 +1,162 @@
+import re
+from collections import Counter
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, column, event, func, literal_column, select, table, text
+from sqlalchemy.dialects.mysql import match
+from tradepilot import db
+from tradepilot.models import Trade, TradingPlan
+
+SEARCH_SCOPES = ('trades', 'plans')
+SEARCH_PAGE_SIZE = 20
+FACET_DIMENSIONS = ('item', 'strategy')
+FACET_LIMIT = 10
+MAX_TERMS = 10
+FTS_PREFIX_LENGTH = 3  # longest prefix kept in the SQLite prefix index
+
+# Text columns indexed for search. On MySQL these are covered by the FULLTEXT indexes declared on
+# the models; on SQLite they are copied into FTS5 tables by the triggers below.
+TRADE_SEARCH_FIELDS = ('item', 'strategy', 'comments')
+PLAN_SEARCH_FIELDS = ('market_conditions', 'goals', 'risk_management', 'entry_exit_criteria', 'trade_setup', 'review_notes',
+                      'news_events', 'premarket_routine', 'timeframe', 'market_type', 'entries', 'stop_loss', 'take_profit')
+
+# SQLite FTS5 tables. Each row carries an "owner" token (u<user_id>) so a user's matches are found by
+# intersecting posting lists inside the index instead of filtering every user's matches afterwards.
+FTS_TABLES = {
+    'trade': ('trade_fts', TRADE_SEARCH_FIELDS),
+    'trading_plan': ('trading_plan_fts', PLAN_SEARCH_FIELDS),
+}
+
+def _fts_ddl(source, fts, fields):
+    columns = ', '.join(fields)
+    new_values = ', '.join(f'new.{field}' for field in fields)
+    assignments = ', '.join(f'{field} = new.{field}' for field in fields)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(owner, {columns}, tokenize='porter unicode61', prefix='2 3')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {source} BEGIN "
+        f"INSERT INTO {fts} (rowid, owner, {columns}) VALUES (new.id, 'u' || new.user_id, {new_values}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {source} BEGIN "
+        f"DELETE FROM {fts} WHERE rowid = old.id; END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF user_id, {columns} ON {source} BEGIN "
+        f"UPDATE {fts} SET owner = 'u' || new.user_id, {assignments} WHERE rowid = old.id; END",
+    ]
+
+# Create the FTS tables and triggers together with the tables they index (db.create_all) on SQLite.
+for source_table, (fts_name, fts_fields) in FTS_TABLES.items():
+    model_table = db.metadata.tables[source_table]
+    for statement in _fts_ddl(source_table, fts_name, fts_fields):
+        event.listen(model_table, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    event.listen(model_table, 'before_drop', DDL(f'DROP TABLE IF EXISTS {fts_name}').execute_if(dialect='sqlite'))
+
+# Create the SQLite FTS tables of an existing database if needed and repopulate them from scratch.
+# MySQL maintains its FULLTEXT indexes itself, so this is a no-op there.
+def rebuild_search_index():
+    if db.engine.dialect.name != 'sqlite':
+        return
+    for source_table, (fts_name, fields) in FTS_TABLES.items():
+        for statement in _fts_ddl(source_table, fts_name, fields):
+            db.session.execute(text(statement))
+        columns = ', '.join(fields)
+        db.session.execute(text(f'DELETE FROM {fts_name}'))
+        db.session.execute(text(f"INSERT INTO {fts_name} (rowid, owner, {columns}) SELECT id, 'u' || user_id, {columns} FROM {source_table}"))
+    db.session.commit()
+
+def parse_terms(query):
+    return re.findall(r'\w+', (query or '').lower())[:MAX_TERMS]
+
+# Every term must match. Terms are stemmed (porter), and a short last term is matched as a prefix
+# (search as you type) through the prefix index; prefix lookups of longer terms would have to merge
+# many posting lists and are an order of magnitude slower.
+def _fts_query(user_id, terms, fields):
+    words = ' '.join(f'"{term}"' for term in terms) + ('*' if len(terms[-1]) <= FTS_PREFIX_LENGTH else '')
+    return f"owner:u{int(user_id)} AND {{{' '.join(fields)}}}: ({words})"
+
+def _boolean_query(terms):
+    return ' '.join(f'+{term}' for term in terms) + '*'
+
+# Select columns of the rows of model matching terms for user_id, plus the expression that orders them
+# by relevance, best first.
+def _matching(model, fields, user_id, terms, columns):
+    if db.engine.dialect.name == 'mysql':
+        relevance = match(*(getattr(model, field) for field in fields), against=_boolean_query(terms)).in_boolean_mode()
+        return select(*columns).where(model.user_id == user_id, relevance > 0), relevance.desc()
+    fts_name = FTS_TABLES[model.__tablename__][0]
+    fts = table(fts_name, column('rowid'))
+    weights = ', '.join(['0.0'] + ['2.0' if field in ('item', 'strategy') else '1.0' for field in fields])
+    statement = select(*columns).join(fts, fts.c.rowid == model.id) \
+        .where(text(f'{fts_name} MATCH :fts_query').bindparams(fts_query=_fts_query(user_id, terms, fields)))
+    # bm25() is lower for better matches
+    return statement, literal_column(f'bm25({fts_name}, {weights})')
+
+# Short excerpt around the first term found in text, with the matching words wrapped in <mark>.
+def make_snippet(text_value, terms, width=80):
+    if not text_value:
+        return Markup('')
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(term) for term in terms) + r')\w*', re.IGNORECASE)
+    found = pattern.search(text_value)
+    start = max(found.start() - width // 2, 0) if found else 0
+    excerpt = text_value[start:start + width]
+    highlighted = pattern.sub(lambda m: f'\x02{m.group(0)}\x03', excerpt)
+    marked = str(escape(highlighted)).replace('\x02', '<mark>').replace('\x03', '</mark>')
+    return Markup(('…' if start else '') + marked + ('…' if start + width < len(text_value) else ''))
+
+def _best_field(row, fields, terms):
+    for field in fields:
+        value = getattr(row, field)
+        if value and any(term in value.lower() for term in terms):
+            return field, value
+    return fields[-1], getattr(row, fields[-1])
+
+def _page_info(total, page):
+    pages = max((total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE, 1)
+    return {'total': total, 'page': page, 'pages': pages}
+
+# Counts per value of each facet over the matching trades. Each facet ignores its own filter so the
+# other values stay visible and selectable.
+def _trade_facets(rows, filters):
+    facets = {}
+    for dimension in FACET_DIMENSIONS:
+        counts = Counter(getattr(row, dimension) or '' for row in rows
+                         if all(getattr(row, other) == value for other, value in filters.items() if other != dimension))
+        facets[dimension] = [{'value': value, 'count': count} for value, count in counts.most_common(FACET_LIMIT)]
+    return facets
+
+# The index is queried once for all of the user's matches (ids and facet columns only), and the
+# total, the facet counts and the requested page are all taken from that one ranked list.
+def search_trades(user_id, query, page=1, filters=None):
+    terms = parse_terms(query)
+    filters = {dimension: value for dimension, value in (filters or {}).items() if dimension in FACET_DIMENSIONS and value}
+    if not terms:
+        return dict(_page_info(0, 1), results=[], facets={dimension: [] for dimension in FACET_DIMENSIONS}, terms=terms)
+
+    statement, relevance = _matching(Trade, TRADE_SEARCH_FIELDS, user_id, terms, [Trade.id, Trade.item, Trade.strategy])
+    rows = db.session.execute(statement.order_by(relevance, Trade.open_time.desc())).all()
+    facets = _trade_facets(rows, filters)
+    rows = [row for row in rows if all(getattr(row, dimension) == value for dimension, value in filters.items())]
+    ids = [row.id for row in rows[(page - 1) * SEARCH_PAGE_SIZE:page * SEARCH_PAGE_SIZE]]
+
+    trades = {trade.id: trade for trade in Trade.query.filter(Trade.id.in_(ids))} if ids else {}
+    results = []
+    for trade_id in ids:
+        trade = trades[trade_id]
+        field, value = _best_field(trade, TRADE_SEARCH_FIELDS, terms)
+        results.append({'id': trade.id, 'ticket': trade.ticket, 'open_time': trade.open_time.isoformat(), 'item': trade.item,
+                        'strategy': trade.strategy, 'profit': float(trade.profit), 'field': field, 'snippet': make_snippet(value, terms)})
+    return dict(_page_info(len(rows), page), results=results, facets=facets, terms=terms)
+
+def search_plans(user_id, query, page=1):
+    terms = parse_terms(query)
+    if not terms:
+        return dict(_page_info(0, 1), results=[], facets={}, terms=terms)
+
+    statement, relevance = _matching(TradingPlan, PLAN_SEARCH_FIELDS, user_id, terms, [TradingPlan.id])
+    total = db.session.execute(select(func.count()).select_from(statement.subquery())).scalar()
+    ids = db.session.execute(statement.order_by(relevance, TradingPlan.date.desc())
+                             .limit(SEARCH_PAGE_SIZE).offset((page - 1) * SEARCH_PAGE_SIZE)).scalars().all()
+
+    plans = {plan.id: plan for plan in TradingPlan.query.filter(TradingPlan.id.in_(ids))} if ids else {}
+    results = []
+    for plan_id in ids:
+        plan = plans[plan_id]
+        field, value = _best_field(plan, PLAN_SEARCH_FIELDS, terms)
+        results.append({'id': plan.id, 'date': plan.date.isoformat(), 'field': field, 'snippet': make_snippet(value, terms)})
+    return dict(_page_info(total, page), results=results, facets={}, terms=terms)
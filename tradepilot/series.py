@@ -0,0 +1,118 @@
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from datetime import timezone
+from tradepilot.trade_cache import cached_trade_rows
+
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+
+# Cumulative P&L (starting from zero, like calculate_max_drawdown) and the underwater curve, i.e. how far
+# each point sits below the running peak, as compact float arrays.
+def build_equity_curve(profits):
+    equity = array('d')
+    drawdown = array('d')
+    total = 0.0
+    peak = 0.0
+    for profit in profits:
+        total += float(profit)
+        if total > peak:
+            peak = total
+        equity.append(total)
+        drawdown.append(total - peak)
+    return equity, drawdown
+
+def _epoch(moment):
+    return moment.replace(tzinfo=timezone.utc).timestamp()
+
+# Equity and drawdown series of a user up to end, trimmed to [start, end]. Trades before start still
+# feed the running total and peak so the trimmed curve keeps its true level and depth.
+def equity_series(user_id, start=None, end=None):
+    rows = cached_trade_rows(user_id, ('profit',), end=end)
+    equity, drawdown = build_equity_curve(row.profit for row in rows)
+    times = array('d', (_epoch(row.open_time) for row in rows))
+    if start is not None:
+        first = bisect_left(times, _epoch(start))
+        times, equity, drawdown = times[first:], equity[first:], drawdown[first:]
+    return times, equity, drawdown
+
+# Largest-Triangle-Three-Buckets: keep the first and last points and, from each of the buckets in
+# between, the point forming the largest triangle with the previous pick and the next bucket's mean.
+def lttb_indices(xs, ys, threshold):
+    length = len(xs)
+    if threshold >= length or threshold < 3:
+        return list(range(length))
+    indices = [0]
+    every = (length - 2) / (threshold - 2)
+    a = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        next_start = end
+        next_end = min(int((bucket + 2) * every) + 1, length)
+        span = next_end - next_start
+        avg_x = sum(xs[next_start:next_end]) / span if span else xs[-1]
+        avg_y = sum(ys[next_start:next_end]) / span if span else ys[-1]
+
+        ax, ay = xs[a], ys[a]
+        best_area = -1.0
+        best = start
+        for index in range(start, min(end, length - 1)):
+            area = abs((ax - avg_x) * (ys[index] - ay) - (ax - xs[index]) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                best = index
+        indices.append(best)
+        a = best
+    indices.append(length - 1)
+    return indices
+
+# Min/max bucketing: keep the lowest and highest point of each bucket, in time order.
+def minmax_indices(ys, threshold):
+    length = len(ys)
+    if threshold >= length or threshold < 4:
+        return list(range(length))
+    buckets = threshold // 2
+    every = length / buckets
+    indices = []
+    for bucket in range(buckets):
+        start = int(bucket * every)
+        end = int((bucket + 1) * every) if bucket < buckets - 1 else length
+        low = min(range(start, end), key=ys.__getitem__)
+        high = max(range(start, end), key=ys.__getitem__)
+        indices.extend(sorted({low, high}))
+    return indices
+
+# Pick the points to ship for a requested point count. The deepest drawdown point is always kept so
+# the downsampled underwater curve shows the true maximum drawdown.
+def downsample(times, equity, drawdown, points, method='lttb'):
+    if method == 'minmax':
+        indices = set(minmax_indices(equity, points))
+    else:
+        indices = set(lttb_indices(times, equity, points))
+    if drawdown:
+        indices.add(min(range(len(drawdown)), key=drawdown.__getitem__))
+    ordered = sorted(indices)
+    return (array('d', (times[i] for i in ordered)),
+            array('d', (equity[i] for i in ordered)),
+            array('d', (drawdown[i] for i in ordered)))
+
+def series_json(times, equity, drawdown, total_points):
+    return {
+        't': [int(value) for value in times],
+        'equity': [round(value, 2) for value in equity],
+        'drawdown': [round(value, 2) for value in drawdown],
+        'points': len(times),
+        'total_points': total_points,
+        'max_drawdown': round(-min(drawdown), 2) if drawdown else 0,
+    }
+
+# Binary layout: little-endian uint32 point count, then the t, equity and drawdown columns as float64 arrays.
+def series_binary(times, equity, drawdown):
+    payload = bytearray(struct.pack('<I', len(times)))
+    for column in (times, equity, drawdown):
+        column = array('d', column)
+        if sys.byteorder == 'big':
+            column.byteswap()
+        payload.extend(column.tobytes())
+    return bytes(payload)
@@ -0,0 +1,80 @@
+from decimal import Decimal
+from tradepilot.series import build_equity_curve
+
+# Calculate maximum drawdown.
+def calculate_max_drawdown(trades):
+    equity_curve, drawdown_curve = build_equity_curve(trade.profit for trade in trades)
+    return abs(min(drawdown_curve, default=0))
+
+def calculate_average_rrr(trades, max_rrr_threshold=10):
+    total_rrr = 0
+    count = 0
+
+    for trade in trades:
+        try:
+            # Ensure all necessary fields are present and numeric
+            if all(hasattr(trade, attr) and isinstance(getattr(trade, attr), (Decimal, float, int)) for attr in ['t_p', 's_l', 'price']):
+                take_profit = float(trade.t_p)
+                stop_loss = float(trade.s_l)
+                entry_price = float(trade.price)
+
+                # Ensure stop_loss and entry_price are not equal to avoid division by zero
+                if stop_loss != entry_price:
+                    rrr = abs(take_profit - entry_price) / abs(stop_loss - entry_price)
+                    # Filter out extremely high RRR values
+                    if rrr <= max_rrr_threshold:
+                        total_rrr += rrr
+                        count += 1
+        except (AttributeError, ValueError):
+            # Skip trades with missing or invalid attributes
+            continue
+
+    return total_rrr / count if count > 0 else 0
+
+# Calculate expectancy.
+def calculate_expectancy(trades):
+    total_profit = sum(float(trade.profit) for trade in trades)
+    return total_profit / len(trades) if trades else 0
+
+# Calculate profit factor.
+def calculate_profit_factor(trades):
+    total_gains = sum(float(trade.profit) for trade in trades if trade.profit > 0)
+    total_losses = abs(sum(float(trade.profit) for trade in trades if trade.profit < 0))
+    return total_gains / total_losses if total_losses > 0 else 0
+
+# Calculate Sharpe ratio.
+def calculate_sharpe_ratio(trades, risk_free_rate=0.02):
+    returns = [float(trade.profit) for trade in trades]
+    avg_return = sum(returns) / len(returns) if returns else 0
+    std_dev = (sum([(x - avg_return) ** 2 for x in returns]) / len(returns)) ** 0.5 if returns else 1
+    return (avg_return - risk_free_rate) / std_dev if std_dev != 0 else 0
+
+# Journal statistics over trade-like rows (profit, size, price, s_l, t_p), as shown on the dashboard.
+def compute_stats(trades):
+    total_trades = len(trades)
+    winning_trades = len([trade for trade in trades if trade.profit > 0])
+    losing_trades = len([trade for trade in trades if trade.profit <= 0])
+    return {
+        'total_trades': total_trades,
+        'winning_trades': winning_trades,
+        'losing_trades': losing_trades,
+        'win_rate': (winning_trades / total_trades * 100) if total_trades > 0 else 0,
+        'average_profit': sum(trade.profit for trade in trades if trade.profit > 0) / winning_trades if winning_trades > 0 else 0,
+        'average_loss': sum(trade.profit for trade in trades if trade.profit <= 0) / losing_trades if losing_trades > 0 else 0,
+        'net_profit': sum(trade.profit for trade in trades),
+        'max_drawdown': calculate_max_drawdown(trades),
+        'average_rrr': calculate_average_rrr(trades),
+        'lots': sum(trade.size for trade in trades),
+        'expectancy': calculate_expectancy(trades),
+        'profit_factor': calculate_profit_factor(trades),
+        'sharpe_ratio': calculate_sharpe_ratio(trades),
+    }
+
+# The statistics as statistics.html displays them, with the ratios formatted.
+def format_stats(stats):
+    return dict(stats,
+                win_rate=f"{stats['win_rate']:.2f}%",
+                average_rrr=f"{stats['average_rrr']:.2f}",
+                expectancy=f"${stats['expectancy']:.2f}",
+                profit_factor=f"{stats['profit_factor']:.2f}",
+                sharpe_ratio=f"{stats['sharpe_ratio']:.2f}")
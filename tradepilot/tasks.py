@@ -0,0 +1,113 @@
+from tradepilot import app, celery, db
+from tradepilot.archive import add_archive_to_rollups, archive_old_trades
+from tradepilot.bars import compute_excursions, load_bars
+from tradepilot.brokers import sync_all_accounts_exclusive
+from tradepilot.db_routing import use_replica
+from tradepilot.ingest import ingest_batch, purge_batches
+from tradepilot.models import ChecklistItem, TradeArchivePartition, UserData
+from tradepilot.montecarlo import execute_run
+from tradepilot.news import load_events
+from tradepilot.nightly import run_nightly
+from tradepilot.reports import render_user_reports, stale_report_users
+from tradepilot.rollups import rebuild_rollups
+from tradepilot.rules import replay_rule_state
+from tradepilot.search import rebuild_search_index
+
+# Poll the broker of every linked account and store the latest balance and equity (beat: every 5 minutes).
+# Skipped while the previous sweep is still running.
+@celery.task
+def update_all_users_balance():
+    return sync_all_accounts_exclusive()
+
+# Backfill the rollup tables (daily_pnl, trade_breakdown) for one user, or for every user when user_id is None.
+# Archived trades are added back from their partitions.
+@celery.task
+def backfill_rollups(user_id=None):
+    rebuild_rollups(user_id)
+    archived = db.session.query(TradeArchivePartition.user_id).distinct()
+    if user_id is not None:
+        archived = archived.filter(TradeArchivePartition.user_id == user_id)
+    for (uid,) in archived.all():
+        add_archive_to_rollups(uid)
+    db.session.commit()
+
+# Rebuild the prop-firm rule state of one user, or of every user when user_id is None.
+@celery.task
+def replay_rule_states(user_id=None):
+    user_ids = [user_id] if user_id is not None else [row.user_id for row in UserData.query.with_entities(UserData.user_id).all()]
+    for uid in user_ids:
+        replay_rule_state(uid)
+    db.session.commit()
+
+# Create and repopulate the SQLite full-text search tables (MySQL keeps its FULLTEXT indexes current itself).
+@celery.task
+def rebuild_search():
+    rebuild_search_index()
+
+# Untick every completed checklist item of every user with one set-wise UPDATE.
+@celery.task
+def reset_checklists():
+    ChecklistItem.query.filter(ChecklistItem.completed.is_(True)).update({ChecklistItem.completed: False}, synchronize_session=False)
+    db.session.commit()
+
+# Run a queued Monte Carlo simulation, spreading its paths over a process pool.
+@celery.task
+def run_monte_carlo(run_id):
+    execute_run(run_id)
+
+# Upsert a batch of trades pushed through the ingestion API.
+@celery.task
+def ingest_trades(batch_id):
+    ingest_batch(batch_id)
+
+# Move trades older than ARCHIVE_AFTER_DAYS out of the live table into compressed per-user files (beat: nightly).
+@celery.task
+def archive_trades(user_id=None):
+    return archive_old_trades(user_id)
+
+# Recompute every user's statistics, rule state and rollups across a process pool (beat: nightly).
+# Resumes from the last checkpoint when the previous run was interrupted.
+@celery.task
+def nightly_analytics():
+    run = run_nightly()
+    return {'users': run.users, 'repaired': run.repaired}
+
+# Load the economic calendar feed (ECONOMIC_CALENDAR_FEED, or the given file) into economic_event (beat: daily).
+@celery.task
+def load_economic_events(path=None):
+    path = path or app.config['ECONOMIC_CALENDAR_FEED']
+    if not path:
+        return None
+    return load_events(path)
+
+# Merge a CSV export of an instrument's OHLC bars into the bar store, then fill in the excursions of
+# that instrument's trades the new bars cover.
+@celery.task
+def load_bar_file(item, path):
+    result = load_bars(item, path)
+    result['trades'] = compute_excursions(symbols=[result['symbol']])
+    return result
+
+# Store MAE and MFE on trades that don't have them yet, for every instrument in the bar store (beat: hourly).
+@celery.task
+def compute_trade_excursions(user_id=None, recompute=False):
+    return compute_excursions(user_id, recompute=recompute)
+
+# Render the weekly and monthly reports of one user whose data changed since they were last rendered.
+@celery.task
+def render_reports(user_id):
+    return render_user_reports(user_id)
+
+# Fan report rendering out over the workers, one task per user with stale reports (beat: hourly).
+@celery.task
+def queue_reports():
+    with use_replica():
+        user_ids = stale_report_users()
+    for user_id in user_ids:
+        render_reports.delay(user_id)
+    return len(user_ids)
+
+# Drop ingestion batches processed more than a week ago.
+@celery.task
+def purge_ingest_batches():
+    purge_batches()
@@ -0,0 +1,156 @@
+import sys
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+import numpy as np
+from sqlalchemy import func, or_
+from tradepilot import app, db
+from tradepilot.archive import trade_row_type, trade_rows
+from tradepilot.models import Trade, UserData
+
+# Trade columns kept in the cache besides open_time and id: what the analytics views read. The text
+# columns (comments, screenshots) are never cached.
+CACHE_COLUMNS = ('close_time', 'trade_type', 'size', 'item', 'price', 's_l', 't_p', 'profit', 'strategy')
+TIME_COLUMNS = ('open_time', 'close_time')
+MONEY_COLUMNS = {'price': 5, 's_l': 5, 't_p': 5, 'profit': 2}  # Decimal places, kept as whole units of the last one
+LABEL_COLUMNS = ('trade_type', 'item', 'strategy')  # Kept as codes into the entry's label list
+COLUMN_TYPES = dict({'id': np.int64, 'size': np.float64},
+                    **dict.fromkeys(TIME_COLUMNS, 'datetime64[us]'),
+                    **dict.fromkeys(MONEY_COLUMNS, np.int64),
+                    **dict.fromkeys(LABEL_COLUMNS, np.int32))
+
+def _scaled(value, places):
+    return int(round(Decimal(value).scaleb(places)))
+
+def _decimal(units, places):
+    return Decimal(units).scaleb(-places)
+
+# One user's trades as flat arrays sorted by (open_time, id), 76 bytes a trade. Entries are
+# never modified once cached: a refresh builds a new one, so readers in other threads always see
+# a consistent set of columns.
+class TradeColumns:
+    __slots__ = ('version', 'live', 'max_id', 'columns', 'labels', 'nbytes')
+
+    def __init__(self, version, live, columns=None, labels=None):
+        self.version = version  # UserData.data_version the columns reflect
+        self.live = live  # Trades of the user in the live table, to notice deletes
+        self.columns = columns or {name: np.empty(0, dtype) for name, dtype in COLUMN_TYPES.items()}
+        self.labels = labels or []
+        self.max_id = int(self.columns['id'].max()) if len(self.columns['id']) else 0
+        self.nbytes = sum(column.nbytes for column in self.columns.values()) + sum(map(sys.getsizeof, self.labels))
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def _encode(self, rows, labels):
+        codes = {label: code for code, label in enumerate(labels)}
+        def code(label):
+            if label not in codes:
+                codes[label] = len(labels)
+                labels.append(label)
+            return codes[label]
+        encoded = {'id': [row.id for row in rows], 'size': [row.size for row in rows]}
+        for name in TIME_COLUMNS:
+            encoded[name] = [getattr(row, name) for row in rows]
+        for name, places in MONEY_COLUMNS.items():
+            encoded[name] = [_scaled(getattr(row, name), places) for row in rows]
+        for name in LABEL_COLUMNS:
+            encoded[name] = [code(getattr(row, name)) for row in rows]
+        return {name: np.array(values, dtype=COLUMN_TYPES[name]) for name, values in encoded.items()}
+
+    # A new entry with rows (namedtuples of open_time, id and CACHE_COLUMNS) inserted, replacing the
+    # cached versions of the trades they describe.
+    def merged(self, rows, version, live):
+        labels = list(self.labels)
+        new = self._encode(rows, labels)
+        keep = ~np.isin(self.columns['id'], new['id'])
+        columns = {name: np.concatenate([column[keep], new[name]]) for name, column in self.columns.items()}
+        order = np.lexsort((columns['id'], columns['open_time']))
+        return TradeColumns(version, live, {name: column[order] for name, column in columns.items()}, labels)
+
+    def _decode(self, name, first, last):
+        values = self.columns[name][first:last]
+        if name in TIME_COLUMNS:
+            return values.astype(object).tolist()
+        if name in MONEY_COLUMNS:
+            return [_decimal(units, MONEY_COLUMNS[name]) for units in values.tolist()]
+        if name in LABEL_COLUMNS:
+            return [self.labels[code] for code in values.tolist()]
+        return values.tolist()
+
+    # The trades opened in [start, end] as trade_rows returns them: namedtuples of open_time, id
+    # and columns, with the same Python types. The range is found by binary search on open_time.
+    def rows(self, columns, start=None, end=None):
+        open_times = self.columns['open_time']
+        first = np.searchsorted(open_times, np.datetime64(start, 'us'), side='left') if start is not None else 0
+        last = np.searchsorted(open_times, np.datetime64(end, 'us'), side='right') if end is not None else len(open_times)
+        fields = tuple(dict.fromkeys(('open_time', 'id') + tuple(columns)))
+        return list(map(trade_row_type(fields), *(self._decode(field, first, last) for field in fields)))
+
+_entries = OrderedDict()  # user_id -> TradeColumns, least recently used first
+_entries_lock = threading.Lock()
+_cached_bytes = 0
+
+def _live_count(user_id):
+    return db.session.query(func.count(Trade.id)).filter(Trade.user_id == user_id).scalar()
+
+def _load(user_id, version):
+    live = _live_count(user_id)
+    return TradeColumns(version, live).merged(trade_rows(user_id, CACHE_COLUMNS), version, live)
+
+# Bring an entry up to version with the trades inserted since it was built (ids above its highest)
+# or written since (stamped with a later data_version). Returns None when trades were deleted or
+# archived meanwhile, which only a full load picks up.
+def _refresh(entry, user_id, version):
+    fields = ('open_time', 'id') + CACHE_COLUMNS
+    row_type = trade_row_type(fields)
+    changed = [row_type(*row) for row in db.session.query(*(getattr(Trade, field) for field in fields))
+               .filter(Trade.user_id == user_id, or_(Trade.id > entry.max_id, Trade.data_version > entry.version))]
+    live = _live_count(user_id)
+    if live != entry.live + sum(1 for row in changed if row.id > entry.max_id):
+        return None
+    return entry.merged(changed, version, live)
+
+def _store(user_id, entry):
+    global _cached_bytes
+    budget = app.config['TRADE_CACHE_MB'] * 1024 * 1024
+    with _entries_lock:
+        previous = _entries.pop(user_id, None)
+        if previous is not None:
+            _cached_bytes -= previous.nbytes
+        if entry.nbytes > budget:
+            return
+        _entries[user_id] = entry
+        _cached_bytes += entry.nbytes
+        while _cached_bytes > budget:
+            _, evicted = _entries.popitem(last=False)
+            _cached_bytes -= evicted.nbytes
+
+# This worker's columns of a user's trades (archived ones included), brought up to the user's current
+# data version first: a cached entry is refreshed with the trades written since, not reloaded.
+def get_trade_columns(user_id):
+    version = UserData.get_data_version(user_id)
+    with _entries_lock:
+        entry = _entries.get(user_id)
+        if entry is not None:
+            _entries.move_to_end(user_id)
+    if entry is not None and entry.version == version:
+        return entry
+    if entry is not None:
+        entry = _refresh(entry, user_id, version)
+    if entry is None:
+        entry = _load(user_id, version)
+    _store(user_id, entry)
+    return entry
+
+# Drop-in for archive.trade_rows served from this worker's cache. Columns the cache doesn't keep, or
+# a TRADE_CACHE_MB of 0, go to the database.
+def cached_trade_rows(user_id, columns, start=None, end=None):
+    if not app.config['TRADE_CACHE_MB'] or not set(columns) <= set(COLUMN_TYPES):
+        return trade_rows(user_id, columns, start, end)
+    return get_trade_columns(user_id).rows(columns, start, end)
+
+def cache_usage():
+    with _entries_lock:
+        return {'users': len(_entries), 'trades': sum(map(len, _entries.values())), 'bytes': _cached_bytes,
+                'budget': app.config['TRADE_CACHE_MB'] * 1024 * 1024}